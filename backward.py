@@ -0,0 +1,211 @@
+import threading
+from util import *
+from logical_classes import *
+verbose = 0
+
+class Table(object):
+    """Answers found so far for one tabled goal
+
+    Attributes:
+        answers (dictof Fact): answer statement ids => Fact proving it, either
+            a fact stored in the KB or an unstored Fact supported by
+            [fact_1, ..., fact_k, rule]
+        facts (listof Fact): the same Facts in the order they were found;
+            readers iterate it by position, so answers added meanwhile are seen
+        complete (bool): True once no new answers can be found
+    """
+    def __init__(self):
+        """Constructor for an empty, incomplete Table
+        """
+        super(Table, self).__init__()
+        self.answers = {}
+        self.facts = []
+        self.complete = False
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Table({!r}, complete={!r})'.format(len(self.facts), self.complete)
+
+    def add(self, fact):
+        """Record an answer unless its statement is already known
+
+        Args:
+            fact (Fact): fact proving the answer
+        """
+        ids = fact.statement.ids
+        if ids not in self.answers:
+            self.answers[ids] = fact
+            self.facts.append(fact)
+
+    def __iter__(self):
+        """Iterate over the answers by position, including answers added
+            while iterating
+        """
+        i = 0
+        while i < len(self.facts):
+            yield self.facts[i]
+            i += 1
+
+class TabledProver(object):
+    """Goal-directed backward chaining (SLD resolution with tabling) over the
+        facts and backward rules of a KnowledgeBase. Every goal is tabled under
+        its canonical form (see QueryCache.canonical); a goal that calls itself
+        reads its own table instead of recursing, and the goals of one query
+        are re-evaluated together until none of their tables grows, so
+        recursive rules terminate. Tables stay valid until the KB changes.
+
+    Attributes:
+        kb (KnowledgeBase): KB whose facts are the base of every proof
+        rules (dictof listof Rule): rhs predicate id => backward rules
+        tables (dictof Table): canonical goal ids => Table
+        lock (threading.Lock|nullcontext): serializes proofs, which fill the
+            tables; NO_LOCK unless threadsafe
+    """
+    def __init__(self, kb, threadsafe=False):
+        """Constructor for TabledProver
+
+        Args:
+            kb (KnowledgeBase): KB to prove goals in
+            threadsafe (bool): serialize proofs, for concurrent readers
+        """
+        super(TabledProver, self).__init__()
+        self.kb = kb
+        self.rules = {}
+        self.tables = {}
+        self.lock = threading.Lock() if threadsafe else NO_LOCK
+
+    def add_rule(self, rule):
+        """Use rule to prove goals with its rhs predicate
+
+        Args:
+            rule (Rule): rule stored in the KB
+        """
+        self.rules.setdefault(rule.rhs.ids[0], []).append(rule)
+        self.clear()
+
+    def remove_rule(self, rule):
+        """Stop using rule
+
+        Args:
+            rule (Rule): rule removed from the KB
+        """
+        rules = self.rules.get(rule.rhs.ids[0], [])
+        if rule in rules:
+            rules.remove(rule)
+        self.clear()
+
+    def clear(self):
+        """Drop every table, called whenever the KB changes
+        """
+        self.tables = {}
+
+    def answers(self, statement):
+        """Prove a goal
+
+        Args:
+            statement (Statement): goal, may contain variables
+
+        Returns:
+            listof Fact: one Fact per provable instance of the goal
+        """
+        key, _ = QueryCache.canonical(statement)
+        # concurrent readers of a threadsafe KB share the tables
+        with self.lock:
+            table = self.tables.get(key)
+            if table is None or not table.complete:
+                self._solve(key)
+            return list(self.tables[key].facts)
+
+    def _solve(self, key):
+        """INTERNAL USE ONLY
+        Evaluate goal key and every goal it calls until no table grows, then
+            mark them all complete
+        """
+        pending = []
+        self._table(key, pending)
+        changed = True
+        while changed:
+            changed = False
+            # goals called during this pass are appended and evaluated too
+            i = 0
+            while i < len(pending):
+                if self._evaluate(pending[i], pending):
+                    changed = True
+                i += 1
+        printv('Tabled {!r} goals', 1, verbose, [len(pending)])
+        for goal in pending:
+            self.tables[goal].complete = True
+
+    def _table(self, key, pending):
+        """INTERNAL USE ONLY
+        Get the table of goal key, creating it and queueing the goal in
+            pending if it is new
+        """
+        table = self.tables.get(key)
+        if table is None:
+            table = self.tables[key] = Table()
+            pending.append(key)
+        return table
+
+    def _evaluate(self, goal, pending):
+        """INTERNAL USE ONLY
+        Add the answers to goal given by stored facts and by one resolution
+            step with each backward rule; return whether its table grew
+        """
+        table = self.tables[goal]
+        count = len(table.facts)
+        for fact in list(self.kb.facts.candidates(Statement.from_ids(goal))):
+            if match_ids(goal, fact.statement.ids, {}):
+                table.add(fact)
+        for rule in self.rules.get(goal[0], []):
+            bound = self._unify_head(rule.rhs.ids, goal)
+            if bound is not None:
+                self._body(rule, 0, bound, [], goal, table, pending)
+        return len(table.facts) > count
+
+    def _unify_head(self, head, goal):
+        """INTERNAL USE ONLY
+        Bind the variables of a rule head to the constants of a goal; return
+            None if they cannot unify. Goal variables are left to the body.
+        """
+        if len(head) != len(goal):
+            return None
+        variable = SYMBOLS.variable
+        bound = {}
+        for h, g in zip(head[1:], goal[1:]):
+            if variable[g]:
+                continue
+            if variable[h]:
+                if bound.setdefault(h, g) != g:
+                    return None
+            elif h != g:
+                return None
+        return bound
+
+    def _body(self, rule, position, bound, facts, goal, table, pending):
+        """INTERNAL USE ONLY
+        Prove the antecedents of rule from position on, left to right; each
+            complete proof adds the instantiated rhs to table if it is an
+            instance of goal
+        """
+        if position == len(rule.lhs):
+            ids = instantiate_ids(rule.rhs.ids, bound)
+            if ids not in table.answers and match_ids(goal, ids, {}):
+                table.add(Fact(Statement.from_ids(ids), [facts + [rule]]))
+            return
+        pattern = instantiate_ids(rule.lhs[position].ids, bound)
+        for fact in self._candidates(pattern, pending):
+            merged = dict(bound)
+            if match_ids(pattern, fact.statement.ids, merged):
+                self._body(rule, position + 1, merged, facts + [fact], goal, table, pending)
+
+    def _candidates(self, pattern, pending):
+        """INTERNAL USE ONLY
+        Get the facts that may prove pattern: the table of the subgoal for
+            backward predicates, stored facts otherwise
+        """
+        if self.kb.is_backward(pattern[0]):
+            key, _ = QueryCache.canonical(Statement.from_ids(pattern))
+            return self._table(key, pending)
+        return list(self.kb.facts.candidates(Statement.from_ids(pattern)))
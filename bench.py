@@ -0,0 +1,255 @@
+"""Benchmark harness for the KnowledgeBase.
+
+Builds synthetic KBs (genealogies, isa/inst taxonomies and chains of
+multi-antecedent rules), then measures bulk load, saturation, point queries
+and retraction cascades for each inference engine. Results are written as
+JSON, e.g.
+
+    python bench.py --engine rete --workload taxonomy --scale 2 --output rete.json
+"""
+import argparse, json, os, platform, random, sys, time, tracemalloc
+from logical_classes import *
+from student_code import KnowledgeBase
+from rete import ReteEngine
+from seminaive import SemiNaiveEngine
+
+ENGINES = {
+    'currying': lambda: None,
+    'rete': ReteEngine,
+    'seminaive': SemiNaiveEngine,
+}
+
+def genealogy(depth, children=2):
+    """Family tree of motherof facts, depth generations below one root,
+        with parent, grandparent and (recursive) ancestor rules
+
+    Args:
+        depth (int): number of generations below the root
+        children (int): children per person
+
+    Returns:
+        (listof Fact, listof Rule, listof Statement): base facts, rules and
+            point queries
+    """
+    facts = []
+    generation = ['p0']
+    count = 1
+    for _ in range(depth):
+        following = []
+        for parent in generation:
+            for _ in range(children):
+                child = 'p{}'.format(count)
+                count += 1
+                facts.append(Fact(['motherof', parent, child]))
+                following.append(child)
+        generation = following
+    rules = [
+        Rule([[['motherof', '?x', '?y']], ['parentof', '?x', '?y']]),
+        Rule([[['parentof', '?x', '?y'], ['parentof', '?y', '?z']], ['grandparentof', '?x', '?z']]),
+        Rule([[['parentof', '?x', '?y']], ['ancestorof', '?x', '?y']]),
+        Rule([[['parentof', '?x', '?y'], ['ancestorof', '?y', '?z']], ['ancestorof', '?x', '?z']]),
+    ]
+    people = ['p{}'.format(i) for i in range(count)]
+    queries = [Statement(['grandparentof', p, '?z']) for p in people] + \
+              [Statement(['ancestorof', '?x', p]) for p in people]
+    return facts, rules, queries
+
+def taxonomy(depth, fanout=3, instances=2):
+    """Class tree of isa facts with inst facts at the leaves and the rule
+        ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)
+
+    Args:
+        depth (int): depth of the class tree
+        fanout (int): subclasses per class
+        instances (int): instances per leaf class
+
+    Returns:
+        (listof Fact, listof Rule, listof Statement): base facts, rules and
+            point queries
+    """
+    facts = []
+    level = ['c0']
+    count = 1
+    for _ in range(depth):
+        following = []
+        for parent in level:
+            for _ in range(fanout):
+                child = 'c{}'.format(count)
+                count += 1
+                facts.append(Fact(['isa', child, parent]))
+                following.append(child)
+        level = following
+    objects = []
+    for leaf in level:
+        for _ in range(instances):
+            name = 'i{}'.format(len(objects))
+            objects.append(name)
+            facts.append(Fact(['inst', name, leaf]))
+    rules = [Rule([[['inst', '?x', '?y'], ['isa', '?y', '?z']], ['inst', '?x', '?z']])]
+    queries = [Statement(['inst', o, '?c']) for o in objects] + \
+              [Statement(['inst', '?x', 'c{}'.format(i)]) for i in range(count)]
+    return facts, rules, queries
+
+def rule_chain(length, width=50):
+    """Chain of two-antecedent rules ((p_i ?x ?y) (link ?y ?z)) -> (p_i+1 ?x ?z)
+        over a ring of width nodes, so every fact of p_0 derives one fact at
+        each of the length steps
+
+    Args:
+        length (int): number of rules in the chain
+        width (int): number of nodes and of p_0 facts
+
+    Returns:
+        (listof Fact, listof Rule, listof Statement): base facts, rules and
+            point queries
+    """
+    nodes = ['n{}'.format(i) for i in range(width)]
+    facts = [Fact(['link', a, b]) for a, b in zip(nodes, nodes[1:] + nodes[:1])]
+    facts += [Fact(['p0', 's{}'.format(i), n]) for i, n in enumerate(nodes)]
+    rules = [Rule([[['p{}'.format(i), '?x', '?y'], ['link', '?y', '?z']],
+                   ['p{}'.format(i + 1), '?x', '?z']]) for i in range(length)]
+    queries = [Statement(['p{}'.format(length), '?x', n]) for n in nodes] + \
+              [Statement(['p{}'.format(i), 's0', '?y']) for i in range(length + 1)]
+    return facts, rules, queries
+
+WORKLOADS = {
+    'genealogy': lambda scale: genealogy(6 + scale),
+    'taxonomy': lambda scale: taxonomy(4 + scale),
+    'rule_chain': lambda scale: rule_chain(20 * scale, 50 * scale),
+}
+
+def percentiles(latencies):
+    """Summarize latencies in seconds
+
+    Args:
+        latencies (listof float): one duration per operation
+
+    Returns:
+        dict: p50, p90, p99 and max, nearest-rank, None if there are none
+    """
+    ordered = sorted(latencies)
+    def rank(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] if ordered else None
+    return {'p50': rank(0.5), 'p90': rank(0.9), 'p99': rank(0.99),
+            'max': ordered[-1] if ordered else None}
+
+def phase(name, count, seconds, latencies=None, **extra):
+    """Build the result record of one benchmark phase
+
+    Args:
+        name (str): phase name
+        count (int): number of operations
+        seconds (float): total duration
+        latencies (listof float|None): per-operation durations
+        extra: further fields to record
+
+    Returns:
+        dict: result record
+    """
+    result = {'phase': name, 'count': count, 'seconds': seconds,
+              'throughput': count / seconds if seconds else None}
+    if latencies is not None:
+        result['latency'] = percentiles(latencies)
+    result.update(extra)
+    return result
+
+def run(workload, engine, scale=1, queries=200, retractions=50, seed=0):
+    """Benchmark one workload on one engine
+
+    Args:
+        workload (str): key of WORKLOADS
+        engine (str): key of ENGINES
+        scale (int): size parameter passed to the workload generator
+        queries (int): number of point queries to time
+        retractions (int): number of base facts to retract
+        seed (int): seed for sampling queries and retractions
+
+    Returns:
+        dict: parameters, KB sizes, peak memory and one record per phase
+    """
+    rng = random.Random(seed)
+    facts, rules, asks = WORKLOADS[workload](scale)
+    kb = KnowledgeBase([], [], ENGINES[engine]())
+    results = []
+
+    start = time.perf_counter()
+    kb.kb_assert_many(facts)
+    results.append(phase('bulk_load', len(facts), time.perf_counter() - start))
+
+    start = time.perf_counter()
+    kb.kb_assert_many(rules)
+    seconds = time.perf_counter() - start
+    results.append(phase('saturate', len(kb.facts) - len(facts), seconds,
+                         rules=len(rules), kb_rules=len(kb.rules)))
+
+    latencies = []
+    answers = 0
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for query in (rng.choice(asks) for _ in range(queries)):
+                start = time.perf_counter()
+                answers += len(kb.kb_ask(Fact(query)))
+                latencies.append(time.perf_counter() - start)
+        finally:
+            sys.stdout = stdout
+    results.append(phase('point_query', len(latencies), sum(latencies), latencies,
+                         answers=answers, cache_hits=kb.cache.hits))
+
+    latencies = []
+    size = len(kb.facts) + len(kb.rules)
+    for fact in rng.sample(facts, min(retractions, len(facts))):
+        start = time.perf_counter()
+        kb.kb_retract(fact)
+        latencies.append(time.perf_counter() - start)
+    results.append(phase('retract', len(latencies), sum(latencies), latencies,
+                         removed=size - len(kb.facts) - len(kb.rules)))
+
+    # peak memory of building the same KB again, traced apart from the timings;
+    # the items are generated again, since stored ones belong to kb
+    facts, rules, _ = WORKLOADS[workload](scale)
+    tracemalloc.start()
+    try:
+        traced = KnowledgeBase([], [], ENGINES[engine]())
+        traced.kb_assert_many(facts)
+        traced.kb_assert_many(rules)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'workload': workload, 'engine': engine, 'scale': scale, 'seed': seed,
+            'base_facts': len(facts), 'facts': len(traced.facts),
+            'rules': len(traced.rules), 'peak_bytes': peak, 'phases': results}
+
+def main(argv=None):
+    """Run the benchmarks selected on the command line and write JSON
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--engine', action='append', choices=sorted(ENGINES),
+                        help='engine to run, repeatable (default: all)')
+    parser.add_argument('--workload', action='append', choices=sorted(WORKLOADS),
+                        help='workload to run, repeatable (default: all)')
+    parser.add_argument('--scale', type=int, default=1, help='workload size parameter')
+    parser.add_argument('--queries', type=int, default=200, help='point queries to time')
+    parser.add_argument('--retractions', type=int, default=50, help='base facts to retract')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file to write (default: stdout)')
+    args = parser.parse_args(argv)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'runs': [run(workload, engine, args.scale, args.queries, args.retractions, args.seed)
+                 for workload in args.workload or sorted(WORKLOADS)
+                 for engine in args.engine or sorted(ENGINES)],
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,12 @@
+import array
+import collections
+import contextlib
+import heapq
+import threading
+import time
 from util import is_var
+# stands in for the locks of objects only used from one thread
+NO_LOCK = contextlib.nullcontext()
 
 class Fact(object):
     """Represents a fact in our knowledge base. Has a statement containing the
@@ -11,10 +19,19 @@ class Fact(object):
         asserted (bool): boolean flag indicating if fact was asserted instead of
             inferred from other rules/facts in the KB
         supported_by (listof Fact|Rule): Facts/Rules that allow inference of
-            the statement
-        supports_facts (listof Fact): Facts that this fact supports
-        supports_rules (listof Rule): Rules that this fact supports
+            the statement, one list per justification (read-only view)
+        supports_facts (listof Fact): Facts that this fact supports (read-only view)
+        supports_rules (listof Rule): Rules that this fact supports (read-only view)
+        graph (SupportGraph|None): support graph of the KB holding this fact,
+            None until the fact is stored in a KB
+        id (int|None): id of this fact in graph
+        support_count (int): number of live justifications of this fact
+        born (int): KB version at which the fact became visible to queries,
+            see KnowledgeBase.snapshot
     """
+    __slots__ = ('statement', 'asserted', 'graph', 'pending_support', 'id', 'born')
+    name = "fact"
+
     def __init__(self, statement, supported_by=[]):
         """Constructor for Fact setting up useful flags and generating appropriate statement
 
@@ -25,15 +42,23 @@ class Fact(object):
                 the statement
         """
         super(Fact, self).__init__()
-        self.name = "fact"
         self.statement = statement if isinstance(statement, Statement) else Statement(statement)
         self.asserted = not supported_by
-        #self.supported_by = supported_by
-        self.supported_by = []
-        self.supports_facts = []
-        self.supports_rules = []
-        for pair in supported_by:
-           self.supported_by.append(pair)
+        self.graph = None
+        self.id = None
+        self.born = 0
+        # justifications handed to the KB's SupportGraph when this is stored,
+        # a shared empty tuple for asserted items
+        self.pending_support = [list(pair) for pair in supported_by] if supported_by else ()
+
+    supported_by = property(lambda self: supported_by_view(self),
+        doc="Justifications of this fact, see SupportGraph.supported_by")
+    support_count = property(lambda self: support_count_of(self),
+        doc="Number of live justifications of this fact, kept by its SupportGraph")
+    supports_facts = property(lambda self: supports_view(self, Fact),
+        doc="Facts this fact supports, see SupportGraph.dependents")
+    supports_rules = property(lambda self: supports_view(self, Rule),
+        doc="Rules this fact supports, see SupportGraph.dependents")
 
     def __repr__(self):
         """Define internal string representation
@@ -73,6 +98,36 @@ class Fact(object):
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash consistent with ==, so facts can be stored in sets and dicts
+        """
+        return hash(self.statement)
+
+    def key(self):
+        """Canonical, hashable key of this fact (the key of its statement)
+
+        Returns:
+            tuple: canonical key
+        """
+        return self.statement.key()
+
+    def __reduce__(self):
+        """Pickle and copy by rebuilding from the statement first, so the fact
+            is hashable before the support graph holding it is restored
+        """
+        return (Fact, (self.statement,), self.__getstate__())
+
+    def __getstate__(self):
+        """Get the slot values to pickle
+        """
+        return dict((name, getattr(self, name)) for name in Fact.__slots__)
+
+    def __setstate__(self, state):
+        """Restore pickled slot values
+        """
+        for name, value in state.items():
+            setattr(self, name, value)
+
 class Rule(object):
     """Represents a rule in our knowledge base. Has a list of statements (the LHS)
         containing the statements that need to be in our KB for us to infer the
@@ -86,10 +141,20 @@ class Rule(object):
         asserted (bool): boolean flag indicating if rule was asserted instead of
             inferred from other rules/facts in the KB
         supported_by (listof Fact|Rule): Facts/Rules that allow inference of
-            the statement
-        supports_facts (listof Fact): Facts that this rule supports
-        supports_rules (listof Rule): Rules that this rule supports
+            the statement, one list per justification (read-only view)
+        supports_facts (listof Fact): Facts that this rule supports (read-only view)
+        supports_rules (listof Rule): Rules that this rule supports (read-only view)
+        graph (SupportGraph|None): support graph of the KB holding this rule,
+            None until the rule is stored in a KB
+        id (int|None): id of this rule in graph
+        support_count (int): number of live justifications of this rule
+        patterns (listof Pattern): the LHS statements followed by the RHS
+            statement, compiled once with one variable numbering for the rule
     """
+    __slots__ = ('lhs', 'rhs', 'asserted', 'graph', 'pending_support', 'id',
+        'patterns')
+    name = "rule"
+
     def __init__(self, rule, supported_by=[]):
         """Constructor for Rule setting up useful flags and generating appropriate LHS & RHS
 
@@ -100,15 +165,24 @@ class Rule(object):
                 the statement
         """
         super(Rule, self).__init__()
-        self.name = "rule"
         self.lhs = [statement if isinstance(statement, Statement) else Statement(statement) for statement in rule[0]]
         self.rhs = rule[1] if isinstance(rule[1], Statement) else Statement(rule[1])
+        self.patterns = Pattern.compile_all(self.lhs + [self.rhs])
         self.asserted = not supported_by
-        self.supported_by = []
-        self.supports_facts = []
-        self.supports_rules = []
-        for pair in supported_by:
-            self.supported_by.append(pair)
+        self.graph = None
+        self.id = None
+        # justifications handed to the KB's SupportGraph when this is stored,
+        # a shared empty tuple for asserted items
+        self.pending_support = [list(pair) for pair in supported_by] if supported_by else ()
+
+    supported_by = property(lambda self: supported_by_view(self),
+        doc="Justifications of this rule, see SupportGraph.supported_by")
+    support_count = property(lambda self: support_count_of(self),
+        doc="Number of live justifications of this rule, kept by its SupportGraph")
+    supports_facts = property(lambda self: supports_view(self, Fact),
+        doc="Facts this rule supports, see SupportGraph.dependents")
+    supports_rules = property(lambda self: supports_view(self, Rule),
+        doc="Rules this rule supports, see SupportGraph.dependents")
 
     def __repr__(self):
         """Define internal string representation
@@ -152,17 +226,444 @@ class Rule(object):
         """
         return not self == other
 
-class Statement(object):
+    def __hash__(self):
+        """Define hash consistent with ==, so rules can be stored in sets and dicts
+        """
+        return hash(self.key())
+
+    def key(self):
+        """Canonical, hashable key of this rule built from its LHS and RHS keys
+
+        Returns:
+            tuple: canonical key
+        """
+        return (tuple(statement.key() for statement in self.lhs), self.rhs.key())
+
+    def __reduce__(self):
+        """Pickle and copy by rebuilding from LHS and RHS first, so the rule
+            is hashable before the support graph holding it is restored
+        """
+        return (Rule, ([self.lhs, self.rhs],), self.__getstate__())
+
+    def __getstate__(self):
+        """Pickle without the compiled patterns, which hold process-local ids
+        """
+        return dict((name, getattr(self, name)) for name in Rule.__slots__
+                    if name != 'patterns')
+
+    def __setstate__(self, state):
+        """Restore a pickled Rule and recompile its patterns
+        """
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.patterns = Pattern.compile_all(self.lhs + [self.rhs])
+
+def support_count_of(fact_rule):
+    """Get the number of live justifications of a Fact or Rule
+
+    Args:
+        fact_rule (Fact|Rule): item to count justifications of
+
+    Returns:
+        int: 0 unless the item is stored in a KB
+    """
+    if fact_rule.graph is None:
+        return 0
+    return fact_rule.graph.counts[fact_rule.id]
+
+def supported_by_view(fact_rule):
+    """Get the justifications of a Fact or Rule as a list of lists
+
+    Args:
+        fact_rule (Fact|Rule): item to get justifications of
+
+    Returns:
+        listof (listof Fact|Rule): supporters of every justification
+    """
+    if fact_rule.graph is None:
+        return list(fact_rule.pending_support)
+    return fact_rule.graph.supported_by(fact_rule)
+
+def supports_view(fact_rule, kind):
+    """Get the Facts or Rules that a Fact or Rule supports
+
+    Args:
+        fact_rule (Fact|Rule): supporting item
+        kind (type): Fact or Rule, the kind of dependents to return
+
+    Returns:
+        listof Fact|Rule: dependents of the given kind
+    """
+    if fact_rule.graph is None:
+        return []
+    return [d for d in fact_rule.graph.dependents(fact_rule) if isinstance(d, kind)]
+
+class SupportGraph(object):
+    """Justification store of a KnowledgeBase, kept in flat int64 arrays.
+        Stored items get a small integer id, reused once the item is detached.
+        A justification (the facts and rule an item was inferred from) with n
+        supporters is one fixed-size record in the pool of width n:
+
+            derived id, next, previous, then per supporter:
+            supporter id, next edge, previous edge
+
+        next/previous chain the justifications of the same derived item, and
+        each supporter's edges chain the justifications it takes part in, so
+        adding or dropping one touches O(1) records per supporter and
+        retraction only visits the edges it removes. Freed records go on a
+        free list per width, and an open-addressing table of handles finds
+        duplicates in O(1). A [fact, rule] justification takes 9 integers plus
+        its table slot; an item takes 3 integers and its items entry.
+
+        A justification is named by its handle, record index << 6 | width,
+        and its k-th supporter by the edge handle << 6 | k.
+
+    Attributes:
+        items (list): id => stored item, None for free ids
+        counts (array): id => number of live justifications
+        heads (array): 2 * id => handle of the newest justification of the
+            item, 2 * id + 1 => newest edge it takes part in; -1 for none
+        pools (dictof array): width => justification records
+        free (dictof int): width => index of the first free record, -1 for none
+        table (array): handles of live justifications, hashed by derived and
+            supporter ids; 0 is empty, -1 deleted
+    """
+    WIDTH_BITS = 6
+    WIDTH_MASK = (1 << WIDTH_BITS) - 1
+
+    def __init__(self):
+        """Constructor for an empty SupportGraph
+        """
+        super(SupportGraph, self).__init__()
+        self.items = []
+        self.free_ids = []
+        self.counts = array.array('q')
+        self.heads = array.array('q')
+        self.pools = {}
+        self.free = {}
+        self.table = array.array('q', bytes(64))
+        self.used = 0
+        self.size = 0
+
+    def __len__(self):
+        """Number of live justifications
+        """
+        return self.size
+
+    def attach(self, item, add_pending=True):
+        """Give a newly stored item an id and add its pending justifications
+
+        Args:
+            item (Fact|Rule): item just stored in the KB
+            add_pending (bool): add item.pending_support now; pass False when
+                its supporters are not attached yet and call add_pending later
+
+        Raises:
+            ValueError: if item is already stored in a KB, e.g. another one
+        """
+        if item.graph is not None:
+            raise ValueError("{} is already stored in a KnowledgeBase: {}".format(
+                item.name, item.statement if isinstance(item, Fact) else item.rhs))
+        if self.free_ids:
+            i = self.free_ids.pop()
+            self.items[i] = item
+            self.counts[i] = 0
+            self.heads[2 * i] = self.heads[2 * i + 1] = -1
+        else:
+            i = len(self.items)
+            self.items.append(item)
+            self.counts.append(0)
+            self.heads.extend((-1, -1))
+        item.graph = self
+        item.id = i
+        if add_pending:
+            self.add_pending(item)
+
+    def add_pending(self, item):
+        """Add the justifications an attached item was created with
+
+        Args:
+            item (Fact|Rule): attached item
+        """
+        for supporters in item.pending_support:
+            self.add(item, supporters)
+        item.pending_support = ()
+
+    def detach(self, item):
+        """Stop tracking an item removed from the KB, dropping its own
+            justifications and any it still takes part in (see retract)
+
+        Args:
+            item (Fact|Rule): item just removed from the KB
+        """
+        i = item.id
+        heads = self.heads
+        while heads[2 * i] != -1:
+            self._drop(heads[2 * i])
+        while heads[2 * i + 1] != -1:
+            self._drop(heads[2 * i + 1] >> self.WIDTH_BITS)
+        self.items[i] = None
+        self.free_ids.append(i)
+        item.graph = None
+        item.id = None
+
+    def add(self, derived, supporters):
+        """Record that derived follows from supporters, unless already recorded
+
+        Args:
+            derived (Fact|Rule): stored, inferred item
+            supporters (listof Fact|Rule): stored facts and rule it was inferred from
+
+        Returns:
+            bool: whether the justification was new
+        """
+        ids = tuple(supporter.id for supporter in supporters)
+        n = len(ids)
+        if not 0 < n <= self.WIDTH_MASK:
+            raise ValueError("A justification takes 1 to {} supporters".format(self.WIDTH_MASK))
+        d = derived.id
+        position, found = self._find(d, ids)
+        if found:
+            return False
+        pool = self.pools.get(n)
+        if pool is None:
+            pool = self.pools[n] = array.array('q')
+            self.free[n] = -1
+        stride = 3 + 3 * n
+        index = self.free[n]
+        if index >= 0:
+            self.free[n] = pool[index * stride]
+        else:
+            index = len(pool) // stride
+            pool.frombytes(bytes(8 * stride))
+        h = index << self.WIDTH_BITS | n
+        base = index * stride
+        heads = self.heads
+        last = heads[2 * d]
+        pool[base] = d
+        pool[base + 1] = -1
+        pool[base + 2] = last
+        if last != -1:
+            other, at = self._record(last)
+            other[at + 1] = h
+        heads[2 * d] = h
+        for k, supporter in enumerate(ids):
+            edge = h << self.WIDTH_BITS | k
+            at = base + 3 + 3 * k
+            last = heads[2 * supporter + 1]
+            pool[at] = supporter
+            pool[at + 1] = -1
+            pool[at + 2] = last
+            if last != -1:
+                other, other_at = self._edge(last)
+                other[other_at + 1] = edge
+            heads[2 * supporter + 1] = edge
+        self.counts[d] += 1
+        self.size += 1
+        if self.table[position] == 0:
+            self.used += 1
+        self.table[position] = h
+        if self.used * 3 > len(self.table) * 2:
+            self._rehash()
+        return True
+
+    def retract(self, item):
+        """Drop every justification item takes part in
+
+        Args:
+            item (Fact|Rule): supporter about to be removed
+
+        Returns:
+            listof Fact|Rule: stored items that lost at least one justification
+        """
+        found = dict.fromkeys(edge >> self.WIDTH_BITS
+                              for edge in reversed(self._edges(item.id)))
+        touched = {}
+        for h in found:
+            touched[self.items[self._drop(h)]] = None
+        return list(touched)
+
+    def supported(self, item):
+        """Check whether item still has a justification, in O(1)
+
+        Args:
+            item (Fact|Rule): item to check
+
+        Returns:
+            bool
+        """
+        return item.graph is self and self.counts[item.id] > 0
+
+    def supported_by(self, item):
+        """Materialize the justifications of item
+
+        Args:
+            item (Fact|Rule): item to get justifications of
+
+        Returns:
+            listof (listof Fact|Rule): supporters of every justification
+        """
+        items = self.items
+        return [[items[i] for i in ids] for ids in self._justifications(item.id)]
+
+    def dependents(self, item):
+        """Get the items that item helps justify
+
+        Args:
+            item (Fact|Rule): supporting item
+
+        Returns:
+            listof Fact|Rule: dependents in insertion order
+        """
+        found = {}
+        for edge in reversed(self._edges(item.id)):
+            pool, at = self._record(edge >> self.WIDTH_BITS)
+            found[pool[at]] = None
+        return [self.items[i] for i in found]
+
+    def _justifications(self, item_id):
+        """INTERNAL USE ONLY
+        Get the justifications of an item as tuples of supporter ids, oldest
+            first
+        """
+        found = []
+        h = self.heads[2 * item_id]
+        while h != -1:
+            pool, base = self._record(h)
+            found.append(tuple(pool[base + 3:base + 3 + 3 * (h & self.WIDTH_MASK):3]))
+            h = pool[base + 2]
+        found.reverse()
+        return found
+
+    def _edges(self, item_id):
+        """INTERNAL USE ONLY
+        Get the edges of the justifications an item takes part in, newest first
+        """
+        found = []
+        edge = self.heads[2 * item_id + 1]
+        while edge != -1:
+            found.append(edge)
+            pool, at = self._edge(edge)
+            edge = pool[at + 2]
+        return found
+
+    def _record(self, h):
+        """INTERNAL USE ONLY
+        Get the pool and offset of the record of justification h
+        """
+        n = h & self.WIDTH_MASK
+        return self.pools[n], (h >> self.WIDTH_BITS) * (3 + 3 * n)
+
+    def _edge(self, edge):
+        """INTERNAL USE ONLY
+        Get the pool and offset of an edge, i.e. of its supporter id
+        """
+        pool, base = self._record(edge >> self.WIDTH_BITS)
+        return pool, base + 3 + 3 * (edge & self.WIDTH_MASK)
+
+    def _drop(self, h):
+        """INTERNAL USE ONLY
+        Unlink justification h everywhere and free its record; return the
+            id of the item it supported
+        """
+        pool, base = self._record(h)
+        n = h & self.WIDTH_MASK
+        heads = self.heads
+        d = pool[base]
+        following, previous = pool[base + 1], pool[base + 2]
+        if following != -1:
+            other, at = self._record(following)
+            other[at + 2] = previous
+        else:
+            heads[2 * d] = previous
+        if previous != -1:
+            other, at = self._record(previous)
+            other[at + 1] = following
+        ids = []
+        for at in range(base + 3, base + 3 + 3 * n, 3):
+            supporter, following, previous = pool[at], pool[at + 1], pool[at + 2]
+            ids.append(supporter)
+            if following != -1:
+                other, other_at = self._edge(following)
+                other[other_at + 2] = previous
+            else:
+                heads[2 * supporter + 1] = previous
+            if previous != -1:
+                other, other_at = self._edge(previous)
+                other[other_at + 1] = following
+        table = self.table
+        mask = len(table) - 1
+        position = hash((d,) + tuple(ids)) & mask
+        while table[position] != h:
+            position = (position + 1) & mask
+        table[position] = -1
+        self.counts[d] -= 1
+        self.size -= 1
+        pool[base] = self.free[n]
+        self.free[n] = h >> self.WIDTH_BITS
+        return d
+
+    def _find(self, d, ids):
+        """INTERNAL USE ONLY
+        Look up the justification (d, ids) in the table; return its position
+            and True, or the position to insert it at and False
+        """
+        table = self.table
+        mask = len(table) - 1
+        position = hash((d,) + ids) & mask
+        free = -1
+        n = len(ids)
+        while True:
+            h = table[position]
+            if h == 0:
+                return (free if free >= 0 else position), False
+            if h == -1:
+                if free < 0:
+                    free = position
+            elif h & self.WIDTH_MASK == n:
+                pool, base = self._record(h)
+                if pool[base] == d and tuple(pool[base + 3:base + 3 + 3 * n:3]) == ids:
+                    return position, True
+            position = (position + 1) & mask
+
+    def _rehash(self):
+        """INTERNAL USE ONLY
+        Rebuild the table without deleted entries, at most a third full
+        """
+        live = [h for h in self.table if h > 0]
+        size = 8
+        while size < 3 * len(live):
+            size *= 2
+        table = array.array('q', bytes(8 * size))
+        mask = size - 1
+        for h in live:
+            pool, base = self._record(h)
+            n = h & self.WIDTH_MASK
+            position = hash((pool[base],) + tuple(pool[base + 3:base + 3 + 3 * n:3])) & mask
+            while table[position]:
+                position = (position + 1) & mask
+            table[position] = h
+        self.table = table
+        self.used = len(live)
+
+class Statement(tuple):
     """Represents a statement in our knowledge base, e.g. (attacked Ai Nosliw),
         (diamonds Loot), (isa Sorceress Wizard), etc. These statements show up
-        in Facts or on the LHS and RHS of Rules
+        in Facts or on the LHS and RHS of Rules. A Statement is the tuple of
+        its interned symbol ids (see SymbolTable), so it takes no more memory
+        than the tuple and compares and hashes like it; predicate and terms
+        are derived from it on access.
 
     Attributes:
+        ids (tuple of int): symbol id of the predicate followed by the symbol
+            id of every term, the statement itself
         terms (listof Term): List of terms (Variable or Constant) in the
             statement, e.g. 'Nosliw' or '?d'
         predicate (str): The predicate of the statement, e.g. isa, hero, needs
     """
-    def __init__(self, statement_list=[]):
+    __slots__ = ()
+
+    def __new__(cls, statement_list=[]):
         """Constructor for Statements with optional list of Statements that are
             converted to appropriate terms (and one predicate)
 
@@ -172,13 +673,62 @@ class Statement(object):
                 the list is either instantiated Terms or strings to be passed to the
                 Term constructor
         """
-        super(Statement, self).__init__()
-        self.terms = []
-        self.predicate = ""
-
+        intern = SYMBOLS.intern
         if statement_list:
-            self.predicate = statement_list[0]
-            self.terms = [t if isinstance(t, Term) else Term(t) for t in statement_list[1:]]
+            ids = ((intern(statement_list[0]),) +
+                tuple(intern(element_of(t)) for t in statement_list[1:]))
+        else:
+            ids = (intern(""),)
+        return tuple.__new__(cls, ids)
+
+    @classmethod
+    def from_ids(cls, ids):
+        """Build a Statement directly from a tuple of symbol ids
+
+        Args:
+            ids (tuple of int): predicate id followed by term ids
+
+        Returns:
+            Statement
+        """
+        if type(ids) is cls:
+            return ids
+        return tuple.__new__(cls, ids)
+
+    @property
+    def ids(self):
+        """Symbol ids of the predicate and every term (the statement itself)
+        """
+        return self
+
+    @property
+    def predicate(self):
+        """The predicate of the statement (str)
+        """
+        return SYMBOLS.names[self[0]]
+
+    @property
+    def terms(self):
+        """The terms of the statement (listof Term), shared per symbol
+        """
+        terms = SYMBOLS.terms
+        return [terms[i] for i in self[1:]]
+
+    def __reduce__(self):
+        """Pickle by symbol names, since ids are only valid in this process
+        """
+        names = SYMBOLS.names
+        return (Statement, ([names[i] for i in self],))
+
+    def __copy__(self):
+        """Statements are immutable, copies are the statement itself
+        """
+        return self
+
+    def __deepcopy__(self, memo):
+        """Statements are immutable, copies are the statement itself
+        """
+        return self
 
     def __repr__(self):
         """Define internal string representation
@@ -190,22 +740,124 @@ class Statement(object):
         """
         return "(" + self.predicate + " " + ' '.join((str(t) for t in self.terms)) + ")"
 
-    def __eq__(self, other):
-        """Define behavior of == when applied to this object
+    def key(self):
+        """Canonical, hashable key of this statement: the symbol ids of the
+            predicate and of every term
+
+        Returns:
+            tuple of int: canonical key
         """
-        if self.predicate != other.predicate:
-            return False
+        return self
 
-        for self_term, other_term in zip(self.terms, other.terms):
-            if self_term != other_term:
-                return False
+class Pattern(object):
+    """A Statement compiled for fast matching and instantiation. Every variable
+        gets a slot number shared by all patterns of a rule (see compile_all),
+        so matching a ground statement is a few array compares that fill a
+        list of slot values, and instantiating is filling the template.
 
-        return True
+    Attributes:
+        ids (tuple of int): symbol ids of the source statement
+        size (int): number of variable slots in the whole rule
+        constants (tuple of (int, int)): (position, required symbol id)
+        slots (tuple of (int, int)): (position, slot) of the first occurrence
+            of each variable in this statement
+        repeats (tuple of (int, int)): (position, slot) of later occurrences,
+            which must equal the value already in the slot
+        variables (tuple of int): slot => symbol id of the variable
+    """
+    __slots__ = ('ids', 'size', 'constants', 'slots', 'repeats', 'variables')
 
-    def __ne__(self, other):
-        """Define behavior of != when applied to this object
+    def __init__(self, statement, numbering):
+        """Constructor for Pattern
+
+        Args:
+            statement (Statement): statement to compile
+            numbering (dictof int): variable id => slot, shared by the patterns
+                of a rule; new variables are numbered in order of appearance
         """
-        return not self == other
+        super(Pattern, self).__init__()
+        variable = SYMBOLS.variable
+        constants, slots, repeats, seen = [], [], [], set()
+        for position, symbol in enumerate(statement.ids[1:], 1):
+            if not variable[symbol]:
+                constants.append((position, symbol))
+                continue
+            slot = numbering.setdefault(symbol, len(numbering))
+            if slot in seen:
+                repeats.append((position, slot))
+            else:
+                seen.add(slot)
+                slots.append((position, slot))
+        self.ids = statement.ids
+        self.size = 0
+        self.constants = tuple(constants)
+        self.slots = tuple(slots)
+        self.repeats = tuple(repeats)
+        self.variables = ()
+
+    @staticmethod
+    def compile_all(statements):
+        """Compile the statements of a rule with one variable numbering
+
+        Args:
+            statements (listof Statement): LHS statements followed by the RHS
+
+        Returns:
+            listof Pattern
+        """
+        numbering = {}
+        patterns = [Pattern(statement, numbering) for statement in statements]
+        variables = tuple(sorted(numbering, key=numbering.get))
+        for pattern in patterns:
+            pattern.size = len(numbering)
+            pattern.variables = variables
+        return patterns
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Pattern({!r})'.format(Statement.from_ids(self.ids))
+
+    def match(self, ids):
+        """Match a ground statement (e.g. a fact) against this pattern
+
+        Args:
+            ids (tuple of int): Statement.ids of the statement to match
+
+        Returns:
+            listof int|None|None: slot values (None for slots this pattern does
+                not bind), or None if there is no match
+        """
+        if len(ids) != len(self.ids) or ids[0] != self.ids[0]:
+            return None
+        for position, symbol in self.constants:
+            if ids[position] != symbol:
+                return None
+        values = [None] * self.size
+        for position, slot in self.slots:
+            values[slot] = ids[position]
+        for position, slot in self.repeats:
+            if values[slot] != ids[position]:
+                return None
+        return values
+
+    def instantiate(self, values):
+        """Fill the variable positions of this pattern from slot values
+
+        Args:
+            values (listof int|None): slot values, e.g. from match; unbound
+                (None) slots keep their variable
+
+        Returns:
+            tuple of int: ids of the instantiated statement
+        """
+        ids = list(self.ids)
+        for positions in (self.slots, self.repeats):
+            for position, slot in positions:
+                value = values[slot]
+                if value is not None:
+                    ids[position] = value
+        return tuple(ids)
 
 class Term(object):
     """Represents a term (a Variable or Constant) in our knowledge base. Can
@@ -215,6 +867,8 @@ class Term(object):
     Attributes:
         term (Variable|Constant): The Variable or Constant that this term holds (represents)
     """
+    __slots__ = ('term',)
+
     def __init__(self, term):
         """Constructor for Term which converts term to appropriate form
 
@@ -249,12 +903,19 @@ class Term(object):
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash consistent with ==
+        """
+        return hash(self.term.element)
+
 class Variable(object):
     """Represents a variable used in statements
 
     Attributes:
         element (str): The name of the variable, e.g. '?x'
     """
+    __slots__ = ('element',)
+
     def __init__(self, element):
         """Constructor for Variable
 
@@ -278,21 +939,28 @@ class Variable(object):
         """Define behavior of == when applied to this object
         """
         return (self is other
-            or isinstance(other, Term) and self.term.element == other.term.element
+            or isinstance(other, Term) and self.element == other.term.element
             or ((isinstance(other, Variable) or isinstance(other, Constant))
-                and self.term.element == other.element))
+                and self.element == other.element))
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash consistent with ==
+        """
+        return hash(self.element)
+
 class Constant(object):
     """Represents a constant used in statements
 
     Attributes:
         element (str): The value of the constant, e.g. 'Nosliw'
     """
+    __slots__ = ('element',)
+
     def __init__(self, element):
         """Constructor for Constant
 
@@ -316,15 +984,86 @@ class Constant(object):
         """Define behavior of == when applied to this object
         """
         return (self is other
-            or isinstance(other, Term) and self.term.element == other.term.element
+            or isinstance(other, Term) and self.element == other.term.element
             or ((isinstance(other, Variable) or isinstance(other, Constant))
-                and self.term.element == other.element))
+                and self.element == other.element))
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash consistent with ==
+        """
+        return hash(self.element)
+
+def element_of(term):
+    """Get the symbol name of a term given as a str, Term, Variable or Constant
+
+    Args:
+        term (str|Term|Variable|Constant): term to get the name of
+
+    Returns:
+        str: e.g. '?x' or 'Nosliw'
+    """
+    if isinstance(term, Term):
+        return term.term.element
+    if isinstance(term, Variable) or isinstance(term, Constant):
+        return term.element
+    return term
+
+class SymbolTable(object):
+    """Interns predicate, variable and constant names as small integer ids so
+        statements can be stored as tuples of ints and compared cheaply. Each
+        symbol also gets one shared Term, handed out by Statement.terms.
+
+    Attributes:
+        ids (dictof int): name => symbol id
+        names (listof str): symbol id => name
+        variable (listof bool): symbol id => whether it names a variable
+        terms (listof Term): symbol id => shared Term for the symbol
+    """
+    def __init__(self):
+        """Constructor for an empty SymbolTable
+        """
+        super(SymbolTable, self).__init__()
+        self.ids = {}
+        self.names = []
+        self.variable = []
+        self.terms = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        """Number of interned symbols
+        """
+        return len(self.names)
+
+    def intern(self, name):
+        """Get the id of name, adding it to the table if needed
+
+        Args:
+            name (str): symbol name, e.g. 'isa', '?x' or 'cube'
+
+        Returns:
+            int: symbol id
+        """
+        symbol = self.ids.get(name)
+        if symbol is None:
+            with self.lock:
+                symbol = self.ids.get(name)
+                if symbol is None:
+                    symbol = len(self.names)
+                    variable = bool(name) and is_var(name)
+                    self.names.append(name)
+                    self.variable.append(variable)
+                    self.terms.append(Term(Variable(name) if variable else Constant(name)))
+                    # publish the id last, other threads may be reading
+                    self.ids[name] = symbol
+        return symbol
+
+SYMBOLS = SymbolTable()
+
 class Binding(object):
     """Represents a binding of a constant to a variable, e.g. 'Nosliw' might be
         bound to'?d'
@@ -362,12 +1101,32 @@ class Bindings(object):
         bindings_dict (dictof Bindings): bindings involved in match where key is
             bound variable and value is bound value,
             e.g. some_bindings.bindings_dict['?d'] => 'Nosliw'
+        ids (dictof int): the same bindings as symbol ids, used by util.match
+            and util.instantiate
     """
     def __init__(self):
         """Constructor for Bindings creating initially empty instance
         """
         self.bindings = []
         self.bindings_dict = {}
+        self.ids = {}
+
+    @classmethod
+    def from_ids(cls, bound):
+        """Build Bindings from a dict of symbol ids as filled in by util.match_ids,
+            reusing the shared Variable/Constant of each symbol
+
+        Args:
+            bound (dictof int): variable id => value id
+
+        Returns:
+            Bindings
+        """
+        bindings = cls()
+        terms = SYMBOLS.terms
+        for variable, value in bound.items():
+            bindings.add_binding(terms[variable].term, terms[value].term, variable, value)
+        return bindings
 
     def __repr__(self):
         """Define internal string representation
@@ -390,15 +1149,22 @@ class Bindings(object):
                 if (self.bindings_dict and key in self.bindings_dict)
                 else None)
 
-    def add_binding(self, variable, value):
+    def add_binding(self, variable, value, variable_id=None, value_id=None):
         """Add a binding from a variable to a value
 
         Args:
             variable (Variable): the variable to bind to
             value (Constant): the value to bind to the variable
+            variable_id (int|None): symbol id of variable, if already known
+            value_id (int|None): symbol id of value, if already known
         """
         self.bindings_dict[variable.element] = value.element
         self.bindings.append(Binding(variable, value))
+        if variable_id is None:
+            variable_id = SYMBOLS.intern(variable.element)
+        if value_id is None:
+            value_id = SYMBOLS.intern(value.element)
+        self.ids[variable_id] = value_id
 
     def bound_to(self, variable):
         """Check if variable is bound. If so return value bound to it, else False.
@@ -409,10 +1175,9 @@ class Bindings(object):
         Returns:
             Variable|Constant|False: returns bound term if variable is bound else False
         """
-        if variable.element in self.bindings_dict.keys():
-            value = self.bindings_dict[variable.element]
-            if value:
-                return Variable(value) if is_var(value) else Constant(value)
+        value = self.bindings_dict.get(variable.element)
+        if value:
+            return SYMBOLS.terms[SYMBOLS.intern(value)].term
 
         return False
 
@@ -487,3 +1252,783 @@ class ListOfBindings(object):
                 Nothing
         """
         self.list_of_bindings.append((bindings, facts_rules))
+
+class StatementIndex(object):
+    """Discrimination index from statement shape to the items holding that
+        statement. Every item is filed under (predicate, arity) and, for each
+        argument position, under (predicate, arity, position, constant) or
+        (predicate, arity, position, None) when that position holds a variable.
+        A lookup only visits items whose arguments can agree with the query's
+        bound (constant) arguments; util.match still has the final word.
+
+    Attributes:
+        statement_of (function): gets the indexed Statement of an item, or None
+            if the item should not be indexed
+        by_predicate (dictof dict): (predicate id, arity) => items
+        by_position (dictof dict): (predicate id, arity, position,
+            constant id|None) => items
+        seq (dictof int): item => insertion sequence number, used to return
+            candidates in insertion order
+    """
+    def __init__(self, statement_of):
+        """Constructor for StatementIndex
+
+        Args:
+            statement_of (function): gets the indexed Statement of an item
+        """
+        super(StatementIndex, self).__init__()
+        self.statement_of = statement_of
+        self.by_predicate = {}
+        self.by_position = {}
+        self.seq = {}
+        self.counter = 0
+
+    def keys(self, statement):
+        """Get the by_position keys a statement is filed under
+
+        Args:
+            statement (Statement): statement to get keys for
+
+        Returns:
+            listof tuple: one key per argument position
+        """
+        ids = statement.ids
+        pred, arity = ids[0], len(ids) - 1
+        variable = SYMBOLS.variable
+        return [(pred, arity, pos, None if variable[symbol] else symbol)
+                for pos, symbol in enumerate(ids[1:])]
+
+    def add(self, item):
+        """File item under the keys of its statement
+
+        Args:
+            item (Fact|Rule): item to index
+        """
+        statement = self.statement_of(item)
+        if statement is None:
+            return
+        self.seq[item] = self.counter
+        self.counter += 1
+        key = (statement.ids[0], len(statement.ids) - 1)
+        self.by_predicate.setdefault(key, {})[item] = None
+        for key in self.keys(statement):
+            self.by_position.setdefault(key, {})[item] = None
+
+    def remove(self, item):
+        """Remove item from every bucket it is filed under
+
+        Args:
+            item (Fact|Rule): item to drop from the index
+        """
+        if self.seq.pop(item, None) is None:
+            return
+        statement = self.statement_of(item)
+        key = (statement.ids[0], len(statement.ids) - 1)
+        self._discard(self.by_predicate, key, item)
+        for key in self.keys(statement):
+            self._discard(self.by_position, key, item)
+
+    def _discard(self, buckets, key, item):
+        """INTERNAL USE ONLY
+        Remove item from buckets[key], dropping the bucket once it is empty
+        """
+        bucket = buckets[key]
+        del bucket[item]
+        if not bucket:
+            del buckets[key]
+
+    def candidates(self, statement):
+        """Get the items whose statement may match the given statement, in
+            insertion order. Uses the most selective bound argument position.
+
+        Args:
+            statement (Statement): statement to look up
+
+        Returns:
+            iterable of Fact|Rule: candidate items
+        """
+        exact, wild = self._buckets(statement)
+        if not wild:
+            return iter(exact)
+        if not exact:
+            return iter(wild)
+        return heapq.merge(exact, wild, key=self.seq.__getitem__)
+
+    def estimate(self, statement):
+        """Count the candidates of a statement without visiting them, used to
+            estimate the selectivity of a query pattern
+
+        Args:
+            statement (Statement): statement to look up
+
+        Returns:
+            int: number of items candidates(statement) would return
+        """
+        exact, wild = self._buckets(statement)
+        return len(exact) + len(wild)
+
+    def _buckets(self, statement):
+        """INTERNAL USE ONLY
+        Pick the buckets of the most selective bound argument position: items
+            with that constant and items with a variable there, or every item
+            of the predicate and arity when no argument is bound
+        """
+        pred, arity = statement.ids[0], len(statement.ids) - 1
+        best = None
+        for key in self.keys(statement):
+            if key[3] is None:
+                continue
+            exact = self.by_position.get(key, {})
+            wild = self.by_position.get((pred, arity, key[2], None), {})
+            if best is None or len(exact) + len(wild) < len(best[0]) + len(best[1]):
+                best = (exact, wild)
+        if best is None:
+            return self.by_predicate.get((pred, arity), {}), {}
+        return best
+
+class IndexedList(object):
+    """Insertion-ordered collection of Facts or Rules backed by a hash index.
+        Iterates like the list it replaces while membership, lookup and removal
+        are O(1), using the canonical key of each item (see Fact.key/Rule.key)
+
+    Attributes:
+        index (dictof Fact|Rule): maps each stored item to itself; dicts keep
+            insertion order so iteration order matches the old list order
+        statements (StatementIndex|None): secondary index by statement shape,
+            kept in sync with index when statement_of is given
+    """
+    def __init__(self, items=[], statement_of=None):
+        """Constructor for IndexedList, optionally seeded with items
+
+        Args:
+            items (listof Fact|Rule): initial items, duplicates are dropped
+            statement_of (function|None): gets the Statement to file each item
+                under in the secondary StatementIndex, e.g. a fact's statement
+        """
+        super(IndexedList, self).__init__()
+        self.index = {}
+        self.statements = StatementIndex(statement_of) if statement_of else None
+        for item in items:
+            self.append(item)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return repr(list(self.index))
+
+    def __str__(self):
+        """Define external representation when printed
+        """
+        return str(list(self.index))
+
+    def __len__(self):
+        """Define behavior of len
+        """
+        return len(self.index)
+
+    def __iter__(self):
+        """Iterate over stored items in insertion order
+        """
+        return iter(self.index)
+
+    def __contains__(self, item):
+        """Define behavior of `in`
+        """
+        return item in self.index
+
+    def __getitem__(self, key):
+        """Define behavior for positional indexing, e.g. kb.facts[0]. This is
+            O(n) and only kept for compatibility with list-based callers
+        """
+        return list(self.index)[key]
+
+    def __eq__(self, other):
+        """Define behavior of == when applied to this object
+        """
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        """Define behavior of != when applied to this object
+        """
+        return not self == other
+
+    def append(self, item, activate=True):
+        """Add item if an equal item is not already stored
+
+        Args:
+            item (Fact|Rule): item to add
+            activate (bool): file item in the StatementIndex right away; pass
+                False to keep it out of candidates() until activate is called
+        """
+        if item not in self.index:
+            self.index[item] = item
+            if activate:
+                self.activate(item)
+
+    def activate(self, item):
+        """File a stored item in the StatementIndex so candidates() returns it
+
+        Args:
+            item (Fact|Rule): stored item to activate
+        """
+        if self.statements is not None:
+            self.statements.add(item)
+
+    def deactivate(self, item):
+        """Take a stored item out of the StatementIndex, undoing activate
+
+        Args:
+            item (Fact|Rule): stored item to deactivate
+        """
+        if self.statements is not None:
+            self.statements.remove(item)
+
+    def remove(self, item):
+        """Remove the stored item equal to item
+
+        Args:
+            item (Fact|Rule): item to remove
+
+        Raises:
+            ValueError: if no equal item is stored, like list.remove
+        """
+        try:
+            item = self.index.pop(item)
+        except KeyError:
+            raise ValueError("IndexedList.remove(x): x not in list")
+        if self.statements is not None:
+            self.statements.remove(item)
+
+    def get(self, item):
+        """Get the stored item equal to item
+
+        Args:
+            item (Fact|Rule): item we're searching for
+
+        Returns:
+            Fact|Rule|None: stored item, or None if there is none
+        """
+        return self.index.get(item)
+
+    def candidates(self, statement):
+        """Get the activated items whose indexed statement may match statement,
+            in activation order. Falls back to every item without a StatementIndex.
+            Copy the result before adding or removing items while iterating.
+
+        Args:
+            statement (Statement): statement to look up
+
+        Returns:
+            iterable of Fact|Rule: candidate items
+        """
+        if self.statements is None:
+            return iter(self.index)
+        return self.statements.candidates(statement)
+
+    def active(self):
+        """Iterate over the activated items in activation order
+
+        Returns:
+            iterable of Fact|Rule: activated items
+        """
+        if self.statements is None:
+            return iter(self.index)
+        return iter(self.statements.seq)
+
+    def estimate(self, statement):
+        """Count the activated items candidates(statement) would return
+
+        Args:
+            statement (Statement): statement to look up
+
+        Returns:
+            int: number of candidate items
+        """
+        if self.statements is None:
+            return len(self.index)
+        return self.statements.estimate(statement)
+
+class Agenda(object):
+    """Work queue of Facts and Rules waiting for the inference engine. Lets the
+        KnowledgeBase saturate iteratively instead of recursing through
+        kb_assert for every inference.
+
+    Attributes:
+        policy (str): 'fifo' (breadth-first), 'lifo' (depth-first) or
+            'priority' (smallest priority(item) first, FIFO among ties)
+        priority (function|None): item => sortable value, for 'priority'
+        running (bool): True while the KnowledgeBase is draining the agenda
+    """
+    POLICIES = ('fifo', 'lifo', 'priority')
+
+    def __init__(self, policy='fifo', priority=None):
+        """Constructor for Agenda
+
+        Args:
+            policy (str): ordering policy, one of Agenda.POLICIES
+            priority (function|None): item => sortable value, required for
+                the 'priority' policy
+
+        Raises:
+            ValueError: on an unknown policy or a missing priority function
+        """
+        super(Agenda, self).__init__()
+        if policy not in Agenda.POLICIES:
+            raise ValueError("Unknown agenda policy: {!r}".format(policy))
+        if policy == 'priority' and priority is None:
+            raise ValueError("The 'priority' policy needs a priority function")
+        self.policy = policy
+        self.priority = priority
+        self.running = False
+        self.items = collections.deque() if policy != 'priority' else []
+        self.counter = 0
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Agenda({!r}, {!r})'.format(self.policy, len(self))
+
+    def __len__(self):
+        """Number of pending items
+        """
+        return len(self.items)
+
+    def push(self, item):
+        """Add a pending item
+
+        Args:
+            item (Fact|Rule): item to process later
+        """
+        if self.policy == 'priority':
+            heapq.heappush(self.items, (self.priority(item), self.counter, item))
+            self.counter += 1
+        else:
+            self.items.append(item)
+
+    def pop(self):
+        """Remove and return the next pending item according to policy
+
+        Returns:
+            Fact|Rule: next item
+        """
+        if self.policy == 'priority':
+            return heapq.heappop(self.items)[2]
+        if self.policy == 'lifo':
+            return self.items.pop()
+        return self.items.popleft()
+
+class QueryCache(object):
+    """LRU cache of kb_ask answers keyed by the canonicalized query, i.e. the
+        query's symbol ids with its variables renumbered in order of first
+        appearance, so (grandmotherof ada ?X) and (grandmotherof ada ?Y) share
+        an entry. Entries are invalidated by predicate whenever a fact with
+        that predicate enters or leaves the KB.
+
+    Attributes:
+        size (int): maximum number of entries, 0 disables caching
+        entries (OrderedDict): key => answer, least recently used first
+        by_predicate (dictof set): predicate id => keys of cached answers
+        hits (int): number of lookups answered from the cache
+        misses (int): number of lookups that had to be computed
+        lock (threading.Lock|nullcontext): guards the entries, NO_LOCK unless
+            threadsafe
+    """
+    def __init__(self, size=256, threadsafe=False):
+        """Constructor for QueryCache
+
+        Args:
+            size (int): maximum number of entries, 0 disables caching
+            threadsafe (bool): lock the entries, for concurrent kb_ask readers
+        """
+        super(QueryCache, self).__init__()
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.by_predicate = {}
+        self.hits = 0
+        self.misses = 0
+        # concurrent kb_ask readers share the cache
+        self.lock = threading.Lock() if threadsafe else NO_LOCK
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'QueryCache({!r}, {!r}, hits={!r}, misses={!r})'.format(
+                self.size, len(self.entries), self.hits, self.misses)
+
+    def __len__(self):
+        """Number of cached answers
+        """
+        return len(self.entries)
+
+    @staticmethod
+    def canonical(statement):
+        """Canonicalize a query statement
+
+        Args:
+            statement (Statement): query
+
+        Returns:
+            (tuple of int, listof int): canonical ids, where the n-th distinct
+                variable is replaced by the placeholder symbol '? n', and the
+                ids of the query's variables in that order
+        """
+        variable = SYMBOLS.variable
+        variables = []
+        key = [statement.ids[0]]
+        for symbol in statement.ids[1:]:
+            if variable[symbol]:
+                if symbol not in variables:
+                    variables.append(symbol)
+                symbol = QueryCache.placeholder(variables.index(symbol))
+            key.append(symbol)
+        return tuple(key), variables
+
+    @staticmethod
+    def placeholder(n):
+        """Get the symbol id standing for the n-th variable of a canonical
+            query; its name contains a space, so the parser never produces it
+
+        Args:
+            n (int): variable number
+
+        Returns:
+            int: symbol id
+        """
+        return SYMBOLS.intern("? {}".format(n))
+
+    def get(self, key, count_miss=True):
+        """Get a cached answer, counting the hit or miss
+
+        Args:
+            key (tuple of int): canonical query
+            count_miss (bool): count a miss; pass False when the caller will
+                not put the answer it computes instead
+
+        Returns:
+            any|None: cached answer, None on a miss
+        """
+        with self.lock:
+            answer = self.entries.get(key)
+            if answer is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return answer
+
+    def put(self, key, answer):
+        """Cache an answer, evicting the least recently used entry if full
+
+        Args:
+            key (tuple of int): canonical query, key[0] is its predicate id
+            answer (any): answer to cache
+        """
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = answer
+            self.entries.move_to_end(key)
+            self.by_predicate.setdefault(key[0], set()).add(key)
+            while len(self.entries) > self.size:
+                old, _ = self.entries.popitem(last=False)
+                self._forget(old)
+
+    def invalidate(self, predicate):
+        """Drop every cached answer for a predicate
+
+        Args:
+            predicate (int): predicate symbol id
+        """
+        with self.lock:
+            for key in self.by_predicate.pop(predicate, ()):
+                del self.entries[key]
+
+    def clear(self):
+        """Drop every cached answer
+        """
+        self.entries.clear()
+        self.by_predicate.clear()
+
+    def _forget(self, key):
+        """INTERNAL USE ONLY
+        Remove an evicted key from the predicate index
+        """
+        keys = self.by_predicate[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.by_predicate[key[0]]
+
+class Instrumentation(object):
+    """Counters, phase timers and tracing callbacks of a KnowledgeBase, set as
+        kb.stats. When kb.stats is None (the default) the KB and engines skip
+        every measurement behind a single `is not None` check.
+
+    Attributes:
+        counters (Counter): event name => count; the KB and engines count
+            'match_attempts', 'match_successes', 'facts_derived',
+            'rules_derived', 'duplicate_derivations', 'retractions' and
+            'retracted_items'
+        timers (dictof list): phase name => [calls, seconds], for the phases
+            'assert', 'inference', 'ask', 'query' and 'retract'
+        cascades (listof int): number of items removed by each retraction
+        callbacks (listof function): called as callback(event, data) for
+            every event, see emit
+        rules (dictof list): asserted rule => [tries, matches, facts, rules,
+            seconds] accumulated by it and every partial rule derived from it
+        roots (dictof Rule): derived rule => asserted rule it descends from
+    """
+    RULE_FIELDS = ('tries', 'matches', 'facts', 'rules', 'seconds')
+
+    def __init__(self):
+        """Constructor for Instrumentation with everything at zero
+        """
+        super(Instrumentation, self).__init__()
+        self.counters = collections.Counter()
+        self.timers = {}
+        self.cascades = []
+        self.callbacks = []
+        self.rules = {}
+        self.roots = {}
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Instrumentation({!r}, {!r})'.format(dict(self.counters), self.timers)
+
+    def subscribe(self, callback):
+        """Register a tracing callback
+
+        Args:
+            callback (function): called as callback(event, data), with event a
+                str such as 'match' or 'fact_derived' and data a dict
+        """
+        self.callbacks.append(callback)
+
+    def emit(self, event, **data):
+        """Count an event and pass it to the callbacks
+
+        Args:
+            event (str): event name, also the counter incremented
+            data: details handed to the callbacks
+        """
+        self.counters[event] += 1
+        for callback in self.callbacks:
+            callback(event, data)
+
+    def matched(self, rule, success):
+        """Count one attempt to match a fact against an antecedent of rule
+
+        Args:
+            rule (Rule): rule whose antecedent was tried
+            success (bool): whether the fact matched
+        """
+        self.counters['match_attempts'] += 1
+        entry = self._rule(rule)
+        entry[0] += 1
+        if success:
+            self.counters['match_successes'] += 1
+            entry[1] += 1
+        if self.callbacks:
+            for callback in self.callbacks:
+                callback('match', {'rule': rule, 'success': success})
+
+    def derived(self, item):
+        """Count a newly derived fact or rule, charging it to the asserted
+            rule its first justification descends from
+
+        Args:
+            item (Fact|Rule): derived item, not yet stored
+        """
+        is_fact = isinstance(item, Fact)
+        rules = [r for r in item.supported_by[0] if isinstance(r, Rule)]
+        if rules:
+            root = self.roots.get(rules[0], rules[0])
+            if not is_fact:
+                self.roots[item] = root
+            self._rule(root)[2 if is_fact else 3] += 1
+        self.emit('facts_derived' if is_fact else 'rules_derived', item=item,
+                  supported_by=item.supported_by)
+
+    def charge(self, rule, start):
+        """Add the time since start to the asserted rule rule descends from
+
+        Args:
+            rule (Rule): rule that was just evaluated
+            start (float): value returned by start
+        """
+        self._rule(rule)[4] += time.perf_counter() - start
+
+    def rule_report(self, sort='seconds', limit=None):
+        """Per-rule statistics, costliest first
+
+        Args:
+            sort (str): field to sort by, one of RULE_FIELDS
+            limit (int|None): number of rules to return, all if None
+
+        Returns:
+            listof dict: 'rule' (the asserted Rule) and one key per RULE_FIELDS
+
+        Raises:
+            ValueError: on an unknown sort field
+        """
+        if sort not in Instrumentation.RULE_FIELDS:
+            raise ValueError("Unknown rule statistic: {!r}".format(sort))
+        report = [dict(zip(Instrumentation.RULE_FIELDS, entry), rule=rule)
+                  for rule, entry in self.rules.items()]
+        report.sort(key=lambda row: row[sort], reverse=True)
+        return report[:limit] if limit is not None else report
+
+    def _rule(self, rule):
+        """INTERNAL USE ONLY
+        Get the statistics entry of the asserted rule rule descends from
+        """
+        root = self.roots.get(rule, rule)
+        entry = self.rules.get(root)
+        if entry is None:
+            entry = self.rules[root] = [0, 0, 0, 0, 0.0]
+        return entry
+
+    def start(self):
+        """Start timing a phase
+
+        Returns:
+            float: start time, to pass to stop
+        """
+        return time.perf_counter()
+
+    def stop(self, phase, start):
+        """Add the time since start to a phase
+
+        Args:
+            phase (str): phase name
+            start (float): value returned by start
+        """
+        timer = self.timers.setdefault(phase, [0, 0.0])
+        timer[0] += 1
+        timer[1] += time.perf_counter() - start
+
+    def reset(self):
+        """Set every counter and timer back to zero, keeping the callbacks
+        """
+        self.counters.clear()
+        self.timers.clear()
+        self.cascades = []
+        self.rules = {}
+
+    def report(self):
+        """Summarize the measurements
+
+        Returns:
+            dict: 'counters', 'timers' (phase => {'calls', 'seconds'}) and
+                'cascades' (count, total and largest cascade size)
+        """
+        return {
+            'counters': dict(self.counters),
+            'timers': dict((phase, {'calls': calls, 'seconds': seconds})
+                           for phase, (calls, seconds) in self.timers.items()),
+            'cascades': {'count': len(self.cascades), 'total': sum(self.cascades),
+                         'max': max(self.cascades) if self.cascades else 0},
+        }
+
+class ReadWriteLock(object):
+    """Reader/writer lock guarding a KnowledgeBase in threadsafe mode. Any
+        number of threads may read at once; a writer waits for them and runs
+        alone. Waiting writers block new readers, so a stream of queries
+        cannot starve kb_assert. Both sides are reentrant, and the writing
+        thread may also read.
+
+    Attributes:
+        condition (threading.Condition): guards the fields below
+        readers (int): number of threads holding the lock for reading
+        writer (int|None): ident of the thread holding it for writing
+        writes (int): reentrant write depth of writer
+        waiting (int): number of writers waiting for the lock
+        local (threading.local): per-thread read depth
+    """
+    def __init__(self):
+        """Constructor for an unlocked ReadWriteLock
+        """
+        super(ReadWriteLock, self).__init__()
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.writes = 0
+        self.waiting = 0
+        self.local = threading.local()
+
+    def acquire_read(self):
+        """Wait until no writer holds or waits for the lock, then read
+        """
+        depth = getattr(self.local, 'depth', 0)
+        if depth or self.writer == threading.get_ident():
+            # nested read, or the writer reading its own changes
+            self.local.depth = depth + 1
+            return
+        with self.condition:
+            while self.writer is not None or self.waiting:
+                self.condition.wait()
+            self.readers += 1
+        self.local.depth = 1
+
+    def release_read(self):
+        """Release one level of reading
+        """
+        self.local.depth -= 1
+        if self.local.depth or self.writer == threading.get_ident():
+            return
+        with self.condition:
+            self.readers -= 1
+            if not self.readers:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        """Wait until no other thread reads or writes, then write
+
+        Raises:
+            RuntimeError: if this thread holds the lock for reading only,
+                upgrading could deadlock
+        """
+        me = threading.get_ident()
+        if self.writer == me:
+            self.writes += 1
+            return
+        if getattr(self.local, 'depth', 0):
+            raise RuntimeError("cannot write while reading a KnowledgeBase")
+        with self.condition:
+            self.waiting += 1
+            while self.writer is not None or self.readers:
+                self.condition.wait()
+            self.waiting -= 1
+            self.writer = me
+            self.writes = 1
+
+    def release_write(self):
+        """Release one level of writing
+        """
+        self.writes -= 1
+        if self.writes:
+            return
+        with self.condition:
+            self.writer = None
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def read(self):
+        """Context manager holding the lock for reading
+        """
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        """Context manager holding the lock for writing
+        """
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
@@ -1,7 +1,11 @@
 import unittest
-import read, copy
+import read, copy, io, os, sys, tempfile, json, threading, tracemalloc, gc
+import bench
 from logical_classes import *
+from util import match, match_ids, instantiate
 from student_code import KnowledgeBase
+from rete import ReteEngine
+from seminaive import SemiNaiveEngine
 
 class KBTest(unittest.TestCase):
 
@@ -71,6 +75,547 @@ class KBTest(unittest.TestCase):
         answer = self.KB.kb_ask(ask1)
         self.assertEqual(str(answer[0]), "?X : bing")
 
+    def test6(self):
+        # re-asserting equal facts and rules must not grow the KB
+        num_facts, num_rules = len(self.KB.facts), len(self.KB.rules)
+        for item in self.data:
+            self.KB.kb_assert(item)
+        self.assertEqual(len(self.KB.facts), num_facts)
+        self.assertEqual(len(self.KB.rules), num_rules)
+        f1 = read.parse_input("fact: (motherof ada bing)")
+        self.assertTrue(f1 in self.KB.facts)
+        self.assertEqual(hash(f1), hash(self.KB._get_fact(f1)))
+        self.assertFalse(read.parse_input("fact: (motherof ada)") in self.KB.facts)
+
+    def test7(self):
+        # kb_ask only visits facts whose bound arguments agree with the query
+        ask1 = read.parse_input("fact: (motherof ?X chen)")
+        candidates = list(self.KB.facts.candidates(ask1.statement))
+        self.assertEqual([str(f.statement) for f in candidates],
+                         ["(motherof bing chen)", "(motherof dolores chen)"])
+        answer = self.KB.kb_ask(ask1)
+        self.assertEqual([str(b) for b in answer], ["?X : bing", "?X : dolores"])
+        self.assertFalse(self.KB.kb_ask(read.parse_input("fact: (motherof chen ?X)")))
+
+    def test8(self):
+        # only rules whose first LHS statement can match a fact are triggered
+        f1 = read.parse_input("fact: (sisters ada eva)")
+        triggered = [str(r.lhs[0]) for r in self.KB.rules.candidates(f1.statement)]
+        self.assertEqual(triggered, ["(sisters ada ?z)"])
+        f2 = read.parse_input("fact: (unrelated ada eva)")
+        self.assertEqual(list(self.KB.rules.candidates(f2.statement)), [])
+
+    def test10(self):
+        # inference depth is not bounded by the Python recursion limit
+        for policy in Agenda.POLICIES:
+            agenda = Agenda(policy, lambda item: 0)
+            KB = KnowledgeBase([], [], agenda=agenda)
+            KB.kb_assert(read.parse_input("rule: ((next ?x ?y) (reach ?x)) -> (reach ?y)"))
+            for i in range(2000):
+                KB.kb_assert(read.parse_input("fact: (next n{} n{})".format(i, i + 1)))
+            KB.kb_assert(read.parse_input("fact: (reach n0)"))
+            self.assertEqual(len(agenda), 0)
+            self.assertTrue(read.parse_input("fact: (reach n2000)") in KB.facts)
+
+    def test11(self):
+        # bulk assert infers the same facts and rules as one-by-one assert
+        KB = KnowledgeBase([], [], self.KB.ie.__class__())
+        KB.kb_assert_many(read.read_tokenize('statements_kb4.txt') * 2)
+        self.assertEqual(set(KB.facts), set(self.KB.facts))
+        self.assertEqual(set(KB.rules), set(self.KB.rules))
+        answer = KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?X)"))
+        self.assertEqual(sorted(str(b) for b in answer), ["?X : chen", "?X : felix"])
+
+    def test13(self):
+        # statements are stored as interned symbol ids
+        s1 = Statement(["motherof", "ada", "?X"])
+        s2 = Statement(["motherof", Term("ada"), Variable("?X")])
+        self.assertEqual(s1.ids, s2.ids)
+        self.assertEqual(s1, s2)
+        self.assertTrue(s1.terms[0] is s2.terms[0])
+        self.assertEqual(s1.predicate, "motherof")
+        self.assertEqual(str(s1), "(motherof ada ?X)")
+        self.assertFalse(hasattr(s1, "__dict__"))
+        self.assertEqual(copy.deepcopy(self.KB.facts[0]), self.KB.facts[0])
+
+    def test14(self):
+        # match binds repeated variables consistently and instantiate substitutes
+        pattern = Statement(["likes", "?x", "?x", "?y"])
+        self.assertFalse(match(pattern, Statement(["likes", "a", "b", "c"])))
+        bindings = match(pattern, Statement(["likes", "a", "a", "c"]))
+        self.assertEqual(str(bindings), "?X : a, ?Y : c")
+        self.assertEqual(str(instantiate(Statement(["pair", "?y", "?z"]), bindings)),
+                         "(pair c ?z)")
+        bound = {}
+        self.assertTrue(match_ids(pattern.ids, Statement(["likes", "b", "b", "?q"]).ids, bound))
+        self.assertEqual(len(bound), 2)
+
+    def test15(self):
+        # rules compile their statements into patterns with shared variable slots
+        rule = read.parse_input("rule: ((likes ?x ?x ?y) (knows ?y ?z)) -> (pair ?z ?x)")
+        lhs0, lhs1, rhs = rule.patterns
+        self.assertEqual(lhs0.size, 3)
+        self.assertIsNone(lhs0.match(Statement(["likes", "a", "b", "c"]).ids))
+        self.assertIsNone(lhs0.match(Statement(["knows", "a", "a", "c"]).ids))
+        values = lhs0.match(Statement(["likes", "a", "a", "c"]).ids)
+        self.assertEqual(str(Statement.from_ids(lhs1.instantiate(values))), "(knows c ?z)")
+        self.assertEqual(str(Statement.from_ids(rhs.instantiate(values))), "(pair ?z a)")
+
+    def test16(self):
+        # justifications are stored once and retraction follows their edges
+        num_justifications = len(self.KB.support)
+        f1 = read.parse_input("fact: (motherof ada bing)")
+        self.KB.kb_assert(f1)
+        self.KB.kb_assert_many(self.data)
+        self.assertEqual(len(self.KB.support), num_justifications)
+        fact = self.KB._get_fact(f1)
+        supported = sorted(str(f.statement) for f in fact.supports_facts)
+        self.assertTrue("(grandmotherof ada chen)" in supported)
+        self.KB.kb_retract(f1)
+        self.assertEqual(fact.graph, None)
+        for item in list(self.KB.facts) + list(self.KB.rules):
+            self.assertTrue(item.asserted or item.supported_by)
+            self.assertFalse(any(fact in pair for pair in item.supported_by))
+
+    def test18(self):
+        # every stored item counts its live justifications
+        fact = self.KB._get_fact(read.parse_input("fact: (grandmotherof ada felix)"))
+        self.assertTrue(fact.asserted)
+        for item in list(self.KB.facts) + list(self.KB.rules):
+            self.assertEqual(item.support_count, len(item.supported_by))
+            for pair in item.supported_by:
+                self.assertTrue(item in pair[0].supports_facts + pair[0].supports_rules)
+        self.assertEqual(len(self.KB.support),
+                         sum(item.support_count for item in self.KB.facts) +
+                         sum(item.support_count for item in self.KB.rules))
+
+    def test17(self):
+        # batched retraction handles deep chains without recursion
+        KB = KnowledgeBase([], [], self.KB.ie.__class__())
+        KB.kb_assert(read.parse_input("rule: ((next ?x ?y) (reach ?x)) -> (reach ?y)"))
+        KB.kb_assert_many(read.parse_input("fact: (next n{} n{})".format(i, i + 1))
+                          for i in range(2000))
+        KB.kb_assert(read.parse_input("fact: (reach n0)"))
+        self.assertTrue(read.parse_input("fact: (reach n2000)") in KB.facts)
+        KB.kb_retract_many([read.parse_input("fact: (reach n0)"),
+                            read.parse_input("fact: (next n5 n6)"),
+                            read.parse_input("rule: ((reach ?x)) -> (seen ?x)")])
+        self.assertFalse(KB.kb_ask(read.parse_input("fact: (reach ?x)")))
+        self.assertEqual(len(KB.facts), 1999)
+        for item in list(KB.facts) + list(KB.rules):
+            self.assertTrue(item.asserted or KB.support.supported(item))
+
+    def test19(self):
+        # kb_ask answers are cached per query shape and invalidated by predicate
+        self.KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?X)"))
+        self.KB.kb_ask(read.parse_input("fact: (sisters ada ?X)"))
+        hits, misses = self.KB.cache.hits, self.KB.cache.misses
+        answer = self.KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?Y)"))
+        self.assertEqual(str(answer[0]), "?Y : felix")
+        self.assertEqual(self.KB.cache.hits, hits + 1)
+        self.KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        # only the sisters answer survives
+        self.assertEqual(len(self.KB.cache), 1)
+        answer = self.KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?X)"))
+        self.assertEqual(str(answer[0]), "?X : felix")
+        self.assertEqual(self.KB.cache.misses, misses + 1)
+        self.assertFalse(self.KB.kb_ask(read.parse_input("fact: (motherof ada ?X)")))
+
+    def test20(self):
+        # kb_ask_iter streams answers and can stop early
+        ask = read.parse_input("fact: (grandmotherof ada ?X)")
+        answers = self.KB.kb_ask_iter(ask)
+        self.assertEqual(str(next(answers)), "?X : felix")
+        self.assertEqual([str(b) for b in self.KB.kb_ask_iter(ask, limit=1)], ["?X : felix"])
+        self.assertEqual(self.KB.kb_ask_iter(ask, count_only=True), 2)
+        self.assertEqual(self.KB.kb_ask_iter(ask, limit=1, count_only=True), 1)
+        self.assertTrue(self.KB.kb_ask_iter(ask, exists_only=True))
+        self.assertFalse(self.KB.kb_ask_iter(read.parse_input("fact: (motherof felix ?X)"),
+                                             exists_only=True))
+        # streamed answers are not cached, so they count no misses; cached
+        # answers still count as hits
+        hits, misses = self.KB.cache.hits, self.KB.cache.misses
+        self.KB.kb_ask_iter(ask, count_only=True)
+        self.assertEqual((self.KB.cache.hits, self.KB.cache.misses), (hits, misses))
+        self.KB.kb_ask(ask)
+        self.KB.kb_ask_iter(ask, count_only=True)
+        self.assertEqual((self.KB.cache.hits, self.KB.cache.misses), (hits + 1, misses + 1))
+
+    def test21(self):
+        # conjunctive queries join the fact indexes directly
+        answer = self.KB.kb_query([read.parse_input("fact: (motherof ?x ?y)"),
+                                   read.parse_input("fact: (grandmotherof ?z ?y)")])
+        rows = sorted((str(b), str(facts[0].statement)) for b, facts in answer.list_of_bindings)
+        self.assertEqual(rows[0], ("?Z : ada, ?Y : chen, ?X : bing", "(motherof bing chen)"))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(len(self.KB.kb_query([Statement(["sisters", "?a", "?b"]),
+                                               Statement(["motherof", "?c", "?d"])])), 4)
+        self.assertFalse(self.KB.kb_query([Statement(["sisters", "?a", "?b"]),
+                                           Statement(["motherof", "?b", "?c"])]))
+
+    def test22(self):
+        # backward predicates are proved on demand instead of materialized
+        KB = KnowledgeBase([], [], self.KB.ie.__class__(), backward=['grandmotherof'])
+        KB.kb_assert_many(read.read_tokenize('statements_kb4.txt'))
+        self.assertFalse(read.parse_input("fact: (grandmotherof ada chen)") in KB.facts)
+        answer = KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?X)"))
+        self.assertEqual(str(answer[0]), "?X : felix")
+        self.assertEqual(str(answer[1]), "?X : chen")
+        # tabling makes cyclic recursive rules terminate
+        KB = KnowledgeBase([], [], backward=True)
+        KB.kb_assert(read.parse_input("rule: ((next ?x ?y) (reach ?x)) -> (reach ?y)"))
+        for i in range(3):
+            KB.kb_assert(read.parse_input("fact: (next n{} n{})".format(i, (i + 1) % 3)))
+        KB.kb_assert(read.parse_input("fact: (reach n0)"))
+        self.assertEqual(len(KB.kb_ask(read.parse_input("fact: (reach ?x)"))), 3)
+        KB.kb_retract(read.parse_input("fact: (reach n0)"))
+        self.assertFalse(KB.kb_ask(read.parse_input("fact: (reach ?x)")))
+
+    def test23(self):
+        # the streaming parser matches read_tokenize and reports error lines
+        streamed = read.read_stream('statements_kb4.txt')
+        self.assertEqual(str(next(streamed).statement), "(motherof ada bing)")
+        self.assertEqual([str(x) for x in read.read_stream('statements_kb4.txt')],
+                         [str(x) for x in self.data])
+        rule = read.parse_element("rule: ((a ?x)  (c ?x)) -> (b ?x)")
+        self.assertEqual(str(rule.lhs[1]), "(c ?x)")
+        lines = io.StringIO("fact: (a b)\n\nrule: ((a ?x)\n (c ?x) (b ?x)\n")
+        with self.assertRaises(read.ParseError) as error:
+            list(read.read_stream(lines))
+        self.assertEqual(error.exception.line, 3)
+
+    def test24(self):
+        # the parallel loader splits at record boundaries and keeps file order
+        for file in ['statements_kb.txt', 'statements_kb4.txt']:
+            self.assertEqual([str(x) for x in read.read_parallel(file, 2, chunk_size=64)],
+                             [str(x) for x in read.read_tokenize(file)])
+        # fact-only files (no rule header to find) split just as well
+        path = os.path.join(tempfile.mkdtemp(), 'facts.txt')
+        with open(path, 'w') as f:
+            f.writelines("fact: (edge n{} n{})\n".format(i, i + 1) for i in range(2000))
+        self.assertEqual(len(read._chunks(path, 1024)), 47)
+        self.assertEqual([str(x) for x in read.read_parallel(path, 2, chunk_size=1024)],
+                         [str(x) for x in read.read_tokenize(path)])
+
+    def test25(self):
+        # a saved KB loads with the same facts, flags and justifications
+        path = os.path.join(tempfile.mkdtemp(), 'kb.snap')
+        self.KB.save(path)
+        KB = KnowledgeBase.load(path, self.KB.ie.__class__())
+        self.assertEqual(list(KB.facts), list(self.KB.facts))
+        self.assertEqual(list(KB.rules), list(self.KB.rules))
+        self.assertEqual(len(KB.support), len(self.KB.support))
+        fact = KB._get_fact(read.parse_input("fact: (grandmotherof ada chen)"))
+        self.assertFalse(fact.asserted)
+        self.assertEqual(len(fact.supported_by), len(self.KB._get_fact(fact).supported_by))
+        # inference and retraction carry on from the restored state
+        for kb in (KB, self.KB):
+            kb.kb_assert(read.parse_input("fact: (motherof felix gus)"))
+            kb.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        self.assertEqual(list(KB.facts), list(self.KB.facts))
+        # truncated snapshots are rejected, not misread
+        with open(path, 'rb') as f:
+            data = f.read()
+        for size in (9, 20, len(data) - 3):
+            with open(path, 'wb') as f:
+                f.write(data[:size])
+            with self.assertRaises(ValueError):
+                KnowledgeBase.load(path)
+
+    def test26(self):
+        # the benchmark harness produces JSON-ready results for every phase
+        result = bench.run('genealogy', 'currying', scale=0, queries=5, retractions=2)
+        self.assertEqual([p['phase'] for p in result['phases']],
+                         ['bulk_load', 'saturate', 'point_query', 'retract'])
+        self.assertEqual(result['phases'][2]['count'], 5)
+        self.assertTrue(result['peak_bytes'] > 0)
+        json.loads(json.dumps(result))
+
+    def test27(self):
+        # instrumentation counts matches, derivations and retraction cascades
+        KB = KnowledgeBase([], [], self.KB.ie.__class__(), instrument=True)
+        events = []
+        KB.stats.subscribe(lambda event, data: events.append(event))
+        KB.kb_assert_many(self.data)
+        KB.kb_assert(read.parse_input("fact: (motherof ada bing)"))
+        KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        report = KB.stats.report()
+        self.assertEqual(report['counters']['facts_derived'], 6)
+        self.assertTrue(report['counters']['match_attempts'] >= report['counters']['match_successes'] > 0)
+        self.assertEqual(report['timers']['assert']['calls'], 2)
+        self.assertEqual(report['cascades']['count'], 1)
+        self.assertTrue('match' in events and 'retractions' in events)
+        self.assertIsNone(self.KB.stats)
+
+    def test28(self):
+        # rule statistics are charged to the asserted rule partial rules come from
+        KB = KnowledgeBase([], [], self.KB.ie.__class__(), instrument=True)
+        KB.kb_assert_many(self.data)
+        report = KB.stats.rule_report('facts')
+        self.assertEqual(len(report), 3)
+        self.assertTrue(all(row['rule'].asserted for row in report))
+        self.assertEqual(str(report[0]['rule'].rhs), "(parentof ?x ?y)")
+        self.assertEqual(report[0]['facts'], 4)
+        self.assertEqual(sum(row['rules'] for row in report),
+                         KB.stats.counters['rules_derived'])
+        self.assertEqual(len(KB.stats.rule_report('tries', limit=1)), 1)
+        with self.assertRaises(ValueError):
+            KB.stats.rule_report('bogus')
+
+    def test29(self):
+        # concurrent readers see whole writes only: pairs asserted and retracted
+        # together are never seen half-way, nor without their inferences
+        KB = KnowledgeBase([], [], self.KB.ie.__class__(), threadsafe=True)
+        KB.kb_assert(read.parse_input("rule: ((pair ?k left)) -> (seen ?k)"))
+        errors = []
+        done = threading.Event()
+
+        def writer():
+            try:
+                for k in range(300):
+                    batch = [Fact(['pair', 'k%d' % k, 'left']), Fact(['pair', 'k%d' % k, 'right'])]
+                    KB.kb_assert_many(batch)
+                    if k % 2:
+                        KB.kb_retract_many(batch)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                done.set()
+
+        def reader():
+            try:
+                while not done.is_set():
+                    with KB.reading():
+                        pairs = KB.kb_ask_iter(Fact(['pair', '?k', '?s']), count_only=True)
+                        seen = KB.kb_ask_iter(Fact(['seen', '?k']), count_only=True)
+                        rows = KB.kb_query([Statement(['pair', '?k', 'left']),
+                                            Statement(['pair', '?k', 'right'])])
+                    if pairs != 2 * seen or len(rows) != seen:
+                        errors.append((pairs, seen, len(rows)))
+            except Exception as e:
+                errors.append(e)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        try:
+            threads = [threading.Thread(target=writer)] + \
+                      [threading.Thread(target=reader) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+        self.assertEqual(KB.kb_ask_iter(Fact(['seen', '?k']), count_only=True), 150)
+
+    def test30(self):
+        # snapshots keep answering as of when they were taken
+        KB = self.KB
+        ask = Fact(['grandmotherof', '?x', '?y'])
+        def answers(result):
+            return sorted(str(result[i]) for i in range(len(result))) if result else []
+        before = answers(KB.kb_ask(ask))
+        size = len(KB.facts)
+        snap = KB.snapshot()
+        KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        KB.kb_assert(read.parse_input("fact: (motherof ada zed)"))
+        KB.kb_assert(read.parse_input("fact: (motherof zed zoe)"))
+        self.assertNotEqual(answers(KB.kb_ask(ask)), before)
+        self.assertEqual(answers(snap.kb_ask(ask)), before)
+        self.assertEqual(len(snap), size)
+        self.assertEqual(snap.kb_ask_iter(Fact(['motherof', 'ada', 'bing']), exists_only=True), True)
+        self.assertEqual(snap.kb_ask(Fact(['motherof', 'zed', '?y'])), [])
+        self.assertEqual(len(snap.kb_query([Statement(['motherof', 'ada', '?y']),
+                                            Statement(['motherof', '?y', '?z'])])), 1)
+        self.assertTrue(KB.history)
+        snap.close()
+        self.assertEqual(KB.history, {})
+        self.assertEqual(len(KB.snapshot()), len(KB.facts))
+
+    def test31(self):
+        # a rule already firing forward moves to the prover once a predicate
+        # it uses becomes backward, whatever order the rules come in
+        first = read.parse_input("rule: ((c ?x)) -> (d ?x)")
+        second = read.parse_input("rule: ((bw ?x)) -> (c ?x)")
+        for rules in ([first, second], [second, first]):
+            KB = KnowledgeBase([], [], self.KB.ie.__class__(), backward=['bw'])
+            KB.kb_assert(read.parse_input("fact: (bw k)"))
+            for rule in rules:
+                KB.kb_assert(copy.deepcopy(rule))
+            self.assertTrue(KB.is_backward(SYMBOLS.intern('d')))
+            answer = KB.kb_ask(read.parse_input("fact: (d ?x)"))
+            self.assertEqual(str(answer[0]), "?X : k")
+
+    def test32(self):
+        # dropping one of many justifications keeps the others and the reverse edges
+        KB = KnowledgeBase([], [], self.KB.ie.__class__())
+        KB.kb_assert(read.parse_input("rule: ((f ?b) (e ?a)) -> (d ?b)"))
+        KB.kb_assert(read.parse_input("fact: (f b)"))
+        for i in range(5):
+            KB.kb_assert(read.parse_input("fact: (e a{})".format(i)))
+        d = KB._get_fact(read.parse_input("fact: (d b)"))
+
+        def supporters():
+            return sorted(str(s.statement) for j in KB.support.supported_by(d)
+                          for s in j if isinstance(s, Fact) and s.statement.predicate == 'e')
+        self.assertEqual(len(supporters()), 5)
+        KB.kb_retract_many([read.parse_input("fact: (e a1)"), read.parse_input("fact: (e a3)")])
+        self.assertEqual(supporters(), ["(e a0)", "(e a2)", "(e a4)"])
+        self.assertEqual(d.support_count, 3)
+        a2 = KB._get_fact(read.parse_input("fact: (e a2)"))
+        self.assertEqual(KB.support.dependents(a2), [d])
+        KB.kb_retract_many([read.parse_input("fact: (e a{})".format(i)) for i in (0, 2, 4)])
+        self.assertFalse(read.parse_input("fact: (d b)") in KB.facts)
+
+    def test33(self):
+        # KBs that are not threadsafe hold no locks, so they can be deep-copied
+        self.KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?X)"))
+        KB = copy.deepcopy(self.KB)
+        KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        self.assertEqual(len(KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?X)"))), 1)
+        self.assertEqual(len(self.KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?X)"))), 2)
+
+    def test34(self):
+        # a fact retracted and re-asserted stays visible in an older snapshot
+        KB = KnowledgeBase([], [], self.KB.ie.__class__())
+        fact = read.parse_input("fact: (color sky blue)")
+        KB.kb_assert(fact)
+        snap = KB.snapshot()
+        KB.kb_retract(fact)
+        later = KB.snapshot()
+        KB.kb_assert(fact)
+        ask = Fact(['color', '?x', '?y'])
+        self.assertEqual(len(snap), 1)
+        self.assertEqual(snap.kb_ask_iter(ask, count_only=True), 1)
+        self.assertEqual(len(later), 0)
+        self.assertEqual(len(KB.snapshot()), 1)
+
+    def test36(self):
+        # each [fact, rule] justification is a flat record of a few ints
+        graph = SupportGraph()
+        facts = [Fact(['e', 'a{}'.format(i)]) for i in range(5000)]
+        rules = [Rule([[['e', '?x']], ['d', '?x', 'r{}'.format(i)]]) for i in range(5000)]
+        derived = [Fact(['d', 'a{}'.format(i)]) for i in range(5000)]
+        for item in facts + rules + derived:
+            graph.attach(item)
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        for i in range(5000):
+            graph.add(derived[i], [facts[i], rules[i * 7 % 5000]])
+        used = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        self.assertLess(used / 5000, 120)
+        self.assertEqual(graph.supported_by(derived[3]), [[facts[3], rules[21]]])
+        for i in range(5000):
+            graph.retract(facts[i])
+        self.assertEqual(len(graph), 0)
+
+    def test37(self):
+        # items stored in one KB cannot be stored in another
+        fact = Fact(['color', 'sky', 'blue'])
+        rule = Rule([[['color', '?x', 'blue']], ['calm', '?x']])
+        KB = KnowledgeBase([], [], self.KB.ie.__class__())
+        KB.kb_assert(fact)
+        KB.kb_assert(rule)
+        other = KnowledgeBase([], [], self.KB.ie.__class__())
+        self.assertRaises(ValueError, other.kb_assert, fact)
+        self.assertRaises(ValueError, other.kb_assert, rule)
+        self.assertEqual((len(other.facts), len(other.rules), len(other.support)), (0, 0, 0))
+        self.assertEqual(len(KB.kb_ask(Fact(['calm', '?x']))), 1)
+
+    def test38(self):
+        # a Fact is at least 5x smaller than the 801 B it took originally; a
+        # first batch interns the symbols and fills the interpreter's free
+        # lists, which a collection would empty again
+        gc.disable()
+        try:
+            for i in range(5000):
+                Fact(['motherof', 'p{}'.format(i), 'q{}'.format(i)])
+            tracemalloc.start()
+            facts = [Fact(['motherof', 'p{}'.format(i), 'q{}'.format(i)]) for i in range(5000)]
+            used = tracemalloc.get_traced_memory()[0] - sys.getsizeof(facts)
+            tracemalloc.stop()
+        finally:
+            gc.enable()
+        self.assertLess(used / 5000, 801 / 5)
+        self.assertEqual(facts[0].supported_by, [])
+
+class ReteKBTest(KBTest):
+    # runs every KBTest case against the Rete engine
+
+    def setUp(self):
+        file = 'statements_kb4.txt'
+        self.data = read.read_tokenize(file)
+        data = read.read_tokenize(file)
+        self.KB = KnowledgeBase([], [], ReteEngine())
+        for item in data:
+            if isinstance(item, Fact) or isinstance(item, Rule):
+                self.KB.kb_assert(item)
+
+    def test8(self):
+        # no partially instantiated rules are added to the KB
+        self.assertEqual(len(self.KB.rules), 3)
+        self.assertTrue(all(r.asserted for r in self.KB.rules))
+
+    def test9(self):
+        # both engines infer the same facts
+        for file in ['statements_kb.txt', 'statements_kb2.txt', 'statements_kb4.txt']:
+            kb1 = KnowledgeBase([], [])
+            kb2 = KnowledgeBase([], [], ReteEngine())
+            for item in read.read_tokenize(file):
+                kb1.kb_assert(item)
+            for item in read.read_tokenize(file):
+                kb2.kb_assert(item)
+            self.assertEqual(set(kb1.facts), set(kb2.facts))
+
+    def test35(self):
+        # retracting a fact drops its tokens from every co-member and empty buckets
+        engine = ReteEngine()
+        KB = KnowledgeBase([], [], engine)
+        KB.kb_assert(read.parse_input("rule: ((a ?x) (b ?y) (e ?y)) -> (c ?x ?y)"))
+        KB.kb_assert(read.parse_input("fact: (a k)"))
+        for i in range(50):
+            fact = read.parse_input("fact: (b v{})".format(i))
+            KB.kb_assert(fact)
+            KB.kb_retract(fact)
+        a = KB._get_fact(read.parse_input("fact: (a k)"))
+        self.assertEqual(len(engine.memberships[a]), 2)
+        self.assertEqual([(len(n.alpha), len(n.beta)) for n in engine.rule_nodes[KB.rules[0]]],
+                         [(1, 1), (0, 0), (0, 0)])
+
+
+class SemiNaiveKBTest(ReteKBTest):
+    # runs every KBTest case against the semi-naive engine
+
+    def setUp(self):
+        file = 'statements_kb4.txt'
+        self.data = read.read_tokenize(file)
+        data = read.read_tokenize(file)
+        self.KB = KnowledgeBase([], [], SemiNaiveEngine())
+        for item in data:
+            if isinstance(item, Fact) or isinstance(item, Rule):
+                self.KB.kb_assert(item)
+
+    def test9(self):
+        # semi-naive and rule currying infer the same facts
+        for file in ['statements_kb.txt', 'statements_kb2.txt', 'statements_kb4.txt']:
+            kb1 = KnowledgeBase([], [])
+            kb2 = KnowledgeBase([], [], SemiNaiveEngine())
+            for item in read.read_tokenize(file):
+                kb1.kb_assert(item)
+            kb2.kb_assert_many(read.read_tokenize(file))
+            self.assertEqual(set(kb1.facts), set(kb2.facts))
+
+    def test12(self):
+        # bulk load saturates in one round per derivation level
+        ie = SemiNaiveEngine()
+        KB = KnowledgeBase([], [], ie)
+        KB.kb_assert_many(read.read_tokenize('statements_kb4.txt'))
+        self.assertEqual(ie.rounds, 3)
+        self.assertEqual(ie.delta_sizes, [6, 4, 2])
+        self.assertEqual(ie.derived_sizes, [4, 2, 0])
+
 
 def pprint_justification(answer):
     """Pretty prints (hence pprint) justifications for the answer.
@@ -1,5 +1,37 @@
+import io, mmap, multiprocessing, re
 from logical_classes import *
 
+# tokens of a statement: parentheses and runs of anything else but whitespace
+TOKEN = re.compile(r"[()]|[^\s()]+")
+# start of a line holding a new fact or rule, where a file may be split
+RECORD = re.compile(rb"\n(?:fact|rule):")
+
+class ParseError(ValueError):
+    """Raised when a statements file or input string cannot be parsed
+
+    Attributes:
+        line (int|None): line number the bad fact or rule starts on, None for
+            input not read from a file
+    """
+    def __init__(self, reason, line=None):
+        """Constructor for ParseError
+
+        Args:
+            reason (str): what is wrong
+            line (int|None): line number of the bad fact or rule
+        """
+        message = reason
+        if line is not None:
+            message = "line {}: {}".format(line, message)
+        super(ParseError, self).__init__(message)
+        self.reason = reason
+        self.line = line
+
+    def __reduce__(self):
+        """Rebuild from reason and line, e.g. when raised in a worker process
+        """
+        return (ParseError, (self.reason, self.line))
+
 # read_tokenize takes the name of a file, reads it in and tokenizes the
 # statements and rules in that file.
 def read_tokenize(file):
@@ -15,24 +47,226 @@ def read_tokenize(file):
 
     Returns:
         A list of Facts and Rules.
+
+    Raises:
+        ParseError: on a malformed fact or rule, see read_stream
+    """
+    return list(read_stream(file))
+
+def read_stream(file):
+    """Lazily parse a statements file, one Fact or Rule at a time, so a file
+        of any size is read in constant memory. A line starting with "fact:"
+        or "rule:" begins a new element; any other line continues the current
+        one, as in read_tokenize. Lines starting with "#" are comments.
+
+    Args:
+        file (str|file): name of a statements file, or an open text file
+
+    Yields:
+        Fact|Rule: each parsed element, in file order
+
+    Raises:
+        ParseError: on a malformed element, with the line it starts on
+    """
+    if isinstance(file, str):
+        with open(file, "r") as f:
+            for fact_rule in read_stream(f):
+                yield fact_rule
+        return
+    for e, line in _elements(file):
+        yield parse_element(e, line)
+
+def _elements(lines, first=1):
+    """INTERNAL USE ONLY
+    Group lines into fact/rule elements, see read_stream
+
+    Yields:
+        (str, int): text of each element and the line it starts on
     """
-    file = open(file, "r")
-    elements = []
-    current = ""
-    for line in file:
+    current = []
+    start = first
+    for number, line in enumerate(lines, first):
         if line[0:5] in ("fact:", "rule:"):
-            elements.append(current)
-            current = line.rstrip()
+            if current:
+                yield " ".join(current), start
+            current = [line.strip()]
+            start = number
+        elif line[0:1] == "#":
+            continue
+        elif line.strip():
+            if not current:
+                raise ParseError("input header {!r} not recognized".format(
+                    line.strip()[0:5]), number)
+            current.append(line.strip())
+    if current:
+        yield " ".join(current), start
+
+def read_parallel(file, processes=None, chunk_size=1 << 22):
+    """Parse a large statements file in a process pool. The file is memory
+        mapped and split into chunks at record boundaries (lines starting
+        with "fact:" or "rule:"); each worker maps the file itself, parses its
+        chunk and returns the records as ids into its own list of symbol
+        names. The records are merged in file order by interning each name
+        once per chunk, so no Statements are pickled between processes.
+
+    Args:
+        file (str): name of a statements file
+        processes (int|None): number of worker processes, defaults to the
+            number of CPUs; 1 parses in this process
+        chunk_size (int): approximate chunk size in bytes
+
+    Yields:
+        Fact|Rule: each parsed element, in file order, as read_stream
+
+    Raises:
+        ParseError: on a malformed element, with the line it starts on
+    """
+    chunks = _chunks(file, chunk_size)
+    if processes == 1 or len(chunks) <= 1:
+        results = map(_parse_chunk, chunks)
+        for fact_rule in _merge(results):
+            yield fact_rule
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for fact_rule in _merge(pool.imap(_parse_chunk, chunks)):
+            yield fact_rule
+    finally:
+        pool.terminate()
+
+def _chunks(file, chunk_size):
+    """INTERNAL USE ONLY
+    Split a file into (file, start, end, first line) byte ranges that each
+        begin at a record boundary
+    """
+    with open(file, "rb") as f:
+        size = f.seek(0, io.SEEK_END)
+        if size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            bounds = [0]
+            while bounds[-1] + chunk_size < size:
+                # one forward search for either header, so a header that
+                # never comes again does not rescan the rest of the file
+                record = RECORD.search(data, bounds[-1] + chunk_size)
+                if record is None:
+                    break
+                bounds.append(record.start() + 1)
+            bounds.append(size)
+            chunks = []
+            line = 1
+            for start, end in zip(bounds, bounds[1:]):
+                chunks.append((file, start, end, line))
+                line += data[start:end].count(b"\n")
+    return chunks
+
+def _parse_chunk(chunk):
+    """INTERNAL USE ONLY
+    Parse one chunk, run in a worker process
+
+    Returns:
+        (listof str, listof (tuple|None, tuple)): symbol names used in the
+            chunk, and each record as (LHS statements|None, statement) with
+            every token replaced by its index in the names
+    """
+    file, start, end, first = chunk
+    with open(file, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            text = data[start:end].decode("utf-8")
+    ids = {}
+    def encode(tokens):
+        return tuple(ids.setdefault(t, len(ids)) for t in tokens)
+    records = []
+    for e, line in _elements(io.StringIO(text, newline=None), first):
+        lhs, rhs = _tokens(e, line)
+        if lhs is not None:
+            lhs = tuple(encode(statement) for statement in lhs)
+        records.append((lhs, encode(rhs)))
+    return list(ids), records
+
+def _merge(results):
+    """INTERNAL USE ONLY
+    Turn the records of parsed chunks into Facts and Rules, translating the
+        chunk-local ids into SYMBOLS ids
+    """
+    for names, records in results:
+        symbol = [SYMBOLS.intern(name) for name in names].__getitem__
+        for lhs, rhs in records:
+            rhs = Statement.from_ids(tuple(map(symbol, rhs)))
+            if lhs is None:
+                yield Fact(rhs)
+            else:
+                yield Rule([[Statement.from_ids(tuple(map(symbol, s))) for s in lhs], rhs])
+
+def parse_element(e, line=None):
+    """Parse one fact or rule in a single pass over its tokens
+
+    Args:
+        e (str): element starting with "fact:" or "rule:"
+        line (int|None): line number of the element, for error messages
+
+    Returns:
+        Fact|Rule: parsed element
+
+    Raises:
+        ParseError: on an unknown header, unbalanced parentheses, a missing
+            "->" or an empty statement
+    """
+    lhs, rhs = _tokens(e, line)
+    if lhs is None:
+        return Fact(rhs)
+    return Rule([lhs, rhs])
+
+def _tokens(e, line):
+    """INTERNAL USE ONLY
+    Split a fact or rule into token lists, see parse_element
+
+    Returns:
+        (listof listof str|None, listof str): LHS statements (None for a fact)
+            and the fact statement or RHS
+    """
+    header, body = e[0:5], e[5:]
+    if header == "fact:":
+        statement = [t for group in _groups(body, line) for t in group]
+        if not statement:
+            raise ParseError("empty fact", line)
+        return None, statement
+    elif header == "rule:":
+        lhs, arrow, rhs = body.partition("->")
+        if not arrow:
+            raise ParseError("rule without '->'", line)
+        lhs = _groups(lhs, line)
+        rhs = [t for group in _groups(rhs, line) for t in group]
+        if not lhs or not rhs:
+            raise ParseError("rule with an empty side", line)
+        return lhs, rhs
+    raise ParseError("input header {!r} not recognized".format(header), line)
+
+def _groups(text, line):
+    """INTERNAL USE ONLY
+    Tokenize text into the statements it contains, one list of tokens per
+        closing parenthesis, checking that parentheses are balanced
+    """
+    groups = []
+    group = []
+    depth = 0
+    for token in TOKEN.findall(text):
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+            if depth < 0:
+                raise ParseError("unbalanced ')'", line)
+            if group:
+                groups.append(group)
+                group = []
         else:
-            current = current + " " + line.rstrip().strip()
-    elements.append(current)
-    output = []
-    for e in elements:
-        parsed = parse_input(e)
-        if isinstance(parsed, Fact) or isinstance(parsed, Rule):
-            output.append(parsed)
-    file.close()
-    return output
+            group.append(token)
+    if depth:
+        raise ParseError("unbalanced '('", line)
+    if group:
+        groups.append(group)
+    return groups
 
 
 def parse_input(e):
@@ -42,7 +276,11 @@ def parse_input(e):
         e (string): Input string to parse
 
     Returns:
-        (number, string | listof string): label, then parsed input
+        Fact|Rule|str|None: parsed fact or rule, the text of a comment, or
+            None for empty input
+
+    Raises:
+        ParseError: on malformed input, see parse_element
     """
     if len(e) == 0:
         #return (BLANK, None)
@@ -50,19 +288,8 @@ def parse_input(e):
     elif e[0] == '#':
         #return (COMMENT, e)
         return e[1:]
-    elif e[0:5] == "fact:":
-        e = e[5:].replace(")", "").replace("(", "").rstrip().strip().split()
-        #return (FACT, e)
-        return Fact(e)
-    elif e[0:5] == "rule:":
-        e = e[5:].split("->")
-        rhs = e[1].replace(")", "").replace("(", "").rstrip().strip().split()
-        lhs = e[0].rstrip(") ").strip("( ").replace("(", "").split(")")
-        lhs = map(lambda x: x.rstrip().strip().split(), lhs)
-        #return (RULE, [lhs, rhs])
-        return Rule([lhs, rhs])
     else:
-        print("PARSE ERROR: input header", e[0:5], "not recognized.")
+        return parse_element(e)
 
 def get_new_fact_or_rule():
     """Creates a new fact or rule. (instead of args, we use command line input
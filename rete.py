@@ -0,0 +1,254 @@
+from util import *
+from logical_classes import *
+verbose = 0
+
+class JoinNode(object):
+    """One antecedent of a rule in the Rete network. Holds the alpha memory of
+        facts matching its pattern and the beta memory of partial matches
+        (tokens) that satisfy this and every earlier antecedent.
+
+    Attributes:
+        rule (Rule): asserted rule this node belongs to
+        position (int): index of pattern in rule.lhs
+        pattern (Statement): LHS statement this node tests facts against
+        shared (tuple of int): symbol ids of the variables of pattern already
+            bound by earlier antecedents, the hash-join key between alpha and
+            beta memories
+        alpha (dictof dict): join key => {fact: bindings dict}
+        beta (dictof dict): join key of the next node => {facts tuple: bindings dict}
+        next (JoinNode|None): node of the following antecedent, None if last
+    """
+    def __init__(self, rule, position, shared):
+        """Constructor for JoinNode
+
+        Args:
+            rule (Rule): asserted rule this node belongs to
+            position (int): index of the tested statement in rule.lhs
+            shared (tuple of int): join variables, see class docstring
+        """
+        super(JoinNode, self).__init__()
+        self.rule = rule
+        self.position = position
+        self.pattern = rule.lhs[position]
+        self.shared = shared
+        self.alpha = {}
+        self.beta = {}
+        self.next = None
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'JoinNode({!r}, {!r})'.format(self.pattern, self.shared)
+
+    def join_key(self, bindings):
+        """Get the join key of bindings for this node
+
+        Args:
+            bindings (dictof int): variable id => value id
+
+        Returns:
+            tuple: values bound to the shared variables
+        """
+        return tuple(bindings[v] for v in self.shared)
+
+class ReteEngine(object):
+    """Rete-style forward-chaining engine. Each asserted rule is compiled into
+        a chain of JoinNodes; facts are joined incrementally through hash-keyed
+        alpha and beta memories, so no partially instantiated Rules are added
+        to the KB. Derived facts are supported by [fact_1, ..., fact_k, rule],
+        which kb_retract handles the same way as [fact, rule] pairs.
+
+    Attributes:
+        nodes (StatementIndex): JoinNodes indexed by their pattern, so a new
+            fact only reaches the nodes it can match
+        rule_nodes (dictof listof JoinNode): rule => its nodes in LHS order
+        memberships (dictof dict): fact => entries of the alpha and beta
+            memories holding it, as (id(memories), join key, fact or facts
+            tuple) => (memories, join key); used to clean up on removal
+    """
+    def __init__(self):
+        """Constructor for ReteEngine with an empty network
+        """
+        super(ReteEngine, self).__init__()
+        self.nodes = StatementIndex(lambda node: node.pattern)
+        self.rule_nodes = {}
+        self.memberships = {}
+
+    def fact_added(self, fact, kb):
+        """Called by the KB after a new fact is stored
+
+        Args:
+            fact (Fact) - the new fact
+            kb (KnowledgeBase) - the KnowledgeBase it was added to
+        """
+        printv('Rete activating {!r}', 1, verbose, [fact.statement])
+        derived = []
+        stats = kb.stats
+        for node in list(self.nodes.candidates(fact.statement)):
+            start = stats.start() if stats is not None else None
+            matched = self._activate(node, fact, derived)
+            if stats is not None:
+                stats.matched(node.rule, matched)
+                stats.charge(node.rule, start)
+        self._derive(derived, kb)
+
+    def rule_added(self, rule, kb):
+        """Called by the KB after a new rule is stored. Compiles the rule and
+            feeds it the facts already in the KB, one antecedent at a time so
+            that every combination of facts is joined exactly once.
+
+        Args:
+            rule (Rule) - the new rule
+            kb (KnowledgeBase) - the KnowledgeBase it was added to
+        """
+        if not rule.lhs:
+            return
+        derived = []
+        stats = kb.stats
+        for node in self._compile(rule):
+            for fact in list(kb.facts.candidates(node.pattern)):
+                start = stats.start() if stats is not None else None
+                matched = self._activate(node, fact, derived)
+                if stats is not None:
+                    stats.matched(rule, matched)
+                    stats.charge(rule, start)
+        self._derive(derived, kb)
+
+    def agenda_empty(self, kb):
+        """Called by the KB whenever its agenda runs dry; nothing to do here
+        """
+        pass
+
+    def kb_loaded(self, kb):
+        """Called by KnowledgeBase.load once a saturated KB is restored.
+            Rebuilds the network and its memories from the stored rules and
+            facts; every inference it makes is already in the KB, so nothing
+            is derived.
+
+        Args:
+            kb (KnowledgeBase) - the restored KnowledgeBase
+        """
+        for rule in list(kb.rules.active()):
+            if rule.lhs:
+                for node in self._compile(rule):
+                    for fact in list(kb.facts.candidates(node.pattern)):
+                        self._activate(node, fact, [])
+
+    def _compile(self, rule):
+        """INTERNAL USE ONLY
+        Build and index the JoinNodes of rule, in LHS order
+        """
+        nodes = []
+        seen = set()
+        for position, pattern in enumerate(rule.lhs):
+            variables = [i for i in pattern.ids[1:] if SYMBOLS.variable[i]]
+            shared = tuple(sorted(seen.intersection(variables)))
+            seen.update(variables)
+            node = JoinNode(rule, position, shared)
+            if nodes:
+                nodes[-1].next = node
+            nodes.append(node)
+            self.nodes.add(node)
+        self.rule_nodes[rule] = nodes
+        return nodes
+
+    def fact_removed(self, fact, kb):
+        """Called by the KB after a fact is removed; drops the fact and every
+            token containing it from the network
+
+        Args:
+            fact (Fact) - the removed fact
+            kb (KnowledgeBase) - the KnowledgeBase it was removed from
+        """
+        for entry, (memories, key) in self.memberships.pop(fact, {}).items():
+            member = entry[2]
+            memory = memories.get(key)
+            if memory is None or member not in memory:
+                continue
+            del memory[member]
+            if not memory:
+                del memories[key]
+            if isinstance(member, tuple):
+                self._unlink(entry, member)
+
+    def rule_removed(self, rule, kb):
+        """Called by the KB after a rule is removed; drops the rule's nodes
+
+        Args:
+            rule (Rule) - the removed rule
+            kb (KnowledgeBase) - the KnowledgeBase it was removed from
+        """
+        for node in self.rule_nodes.pop(rule, []):
+            self.nodes.remove(node)
+            for memories in (node.alpha, node.beta):
+                for key, memory in memories.items():
+                    for member in memory:
+                        self._unlink((id(memories), key, member),
+                                     member if isinstance(member, tuple) else (member,))
+
+    def _activate(self, node, fact, derived):
+        """INTERNAL USE ONLY
+        Store fact in node's alpha memory and join it with the tokens of the
+            previous node; return whether fact matched node's pattern
+        """
+        bindings = {}
+        if not match_ids(node.pattern.ids, fact.statement.ids, bindings):
+            return False
+        key = node.join_key(bindings)
+        node.alpha.setdefault(key, {})[fact] = bindings
+        self._link(node.alpha, key, fact, (fact,))
+        if node.position == 0:
+            self._emit(node, (fact,), bindings, derived)
+            return True
+        previous = self.rule_nodes[node.rule][node.position - 1]
+        for facts, token in list(previous.beta.get(key, {}).items()):
+            merged = dict(token)
+            merged.update(bindings)
+            self._emit(node, facts + (fact,), merged, derived)
+        return True
+
+    def _emit(self, node, facts, bindings, derived):
+        """INTERNAL USE ONLY
+        Handle a token that satisfies node and all earlier antecedents: fire
+            the rule at the last node, otherwise store it and join it with the
+            alpha memory of the next node
+        """
+        if node.next is None:
+            derived.append((facts, bindings, node.rule))
+            return
+        following = node.next
+        key = following.join_key(bindings)
+        node.beta.setdefault(key, {})[facts] = bindings
+        self._link(node.beta, key, facts, facts)
+        for fact, alpha in list(following.alpha.get(key, {}).items()):
+            merged = dict(bindings)
+            merged.update(alpha)
+            self._emit(following, facts + (fact,), merged, derived)
+
+    def _link(self, memories, key, member, facts):
+        """INTERNAL USE ONLY
+        Record that memories[key][member] holds each of facts
+        """
+        entry = (id(memories), key, member)
+        for fact in facts:
+            self.memberships.setdefault(fact, {})[entry] = (memories, key)
+
+    def _unlink(self, entry, facts):
+        """INTERNAL USE ONLY
+        Forget a memory entry that was dropped, for each of facts
+        """
+        for fact in facts:
+            entries = self.memberships.get(fact)
+            if entries is not None:
+                entries.pop(entry, None)
+                if not entries:
+                    del self.memberships[fact]
+
+    def _derive(self, derived, kb):
+        """INTERNAL USE ONLY
+        Add the facts inferred by fired rules to the KB and record support
+        """
+        for facts, bindings, rule in derived:
+            statement = Statement.from_ids(instantiate_ids(rule.rhs.ids, bindings))
+            new_fact = Fact(statement, [list(facts) + [rule]])
+            kb.kb_add(new_fact)
@@ -0,0 +1,151 @@
+from util import *
+from logical_classes import *
+verbose = 0
+
+class SemiNaiveEngine(object):
+    """Forward-chaining engine that saturates the KB in rounds using
+        semi-naive evaluation. Facts processed since the last round form the
+        delta; in each round every rule is only evaluated on joins that use at
+        least one delta fact, so recursive rules such as
+        ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z) never re-derive old facts.
+        A new rule is joined once against every fact in its first round.
+        Derived facts are supported by [fact_1, ..., fact_k, rule].
+
+    Attributes:
+        rules (listof Rule): rules already evaluated in an earlier round
+        new_rules (listof Rule): rules added since the last round
+        delta (dictof None): facts added since the last round, in order
+        rounds (int): number of rounds run so far
+        delta_sizes (listof int): size of the delta joined in each round
+        derived_sizes (listof int): number of new facts derived in each round
+    """
+    def __init__(self):
+        """Constructor for SemiNaiveEngine
+        """
+        super(SemiNaiveEngine, self).__init__()
+        self.rules = []
+        self.new_rules = []
+        self.delta = {}
+        self.rounds = 0
+        self.delta_sizes = []
+        self.derived_sizes = []
+
+    def fact_added(self, fact, kb):
+        """Called by the KB after a new fact is stored; queues it for the
+            next round
+
+        Args:
+            fact (Fact) - the new fact
+            kb (KnowledgeBase) - the KnowledgeBase it was added to
+        """
+        self.delta[fact] = None
+
+    def rule_added(self, rule, kb):
+        """Called by the KB after a new rule is stored; evaluates it against
+            every fact in the next round
+
+        Args:
+            rule (Rule) - the new rule
+            kb (KnowledgeBase) - the KnowledgeBase it was added to
+        """
+        if rule.lhs:
+            self.new_rules.append(rule)
+
+    def agenda_empty(self, kb):
+        """Called by the KB whenever its agenda runs dry; runs one round. The
+            facts it derives are queued on the agenda and become the delta of
+            the following round, until a round derives nothing new.
+
+        Args:
+            kb (KnowledgeBase) - the KnowledgeBase to saturate
+        """
+        if not self.delta and not self.new_rules:
+            return
+        self.rounds += 1
+        self.delta_sizes.append(len(self.delta))
+        delta, self.delta = self.delta, {}
+        new_rules, self.new_rules = self.new_rules, []
+        printv('Semi-naive round {!r}, delta of {!r} facts', 0, verbose,
+            [self.rounds, len(delta)])
+        derived = []
+        stats = kb.stats
+        for rule in self.rules:
+            start = stats.start() if stats is not None else None
+            for position in range(len(rule.lhs)):
+                # start from the delta antecedent, it binds the most variables
+                order = [position] + [i for i in range(len(rule.lhs)) if i != position]
+                self._join(kb, rule, order, position, delta, {}, [None] * len(order), derived)
+            if stats is not None:
+                stats.charge(rule, start)
+        for rule in new_rules:
+            start = stats.start() if stats is not None else None
+            order = list(range(len(rule.lhs)))
+            self._join(kb, rule, order, None, delta, {}, [None] * len(order), derived)
+            if stats is not None:
+                stats.charge(rule, start)
+        self.rules.extend(new_rules)
+        count = len(kb.facts)
+        for facts, bindings, rule in derived:
+            statement = Statement.from_ids(instantiate_ids(rule.rhs.ids, bindings))
+            new_fact = Fact(statement, [list(facts) + [rule]])
+            kb.kb_add(new_fact)
+        self.derived_sizes.append(len(kb.facts) - count)
+
+    def kb_loaded(self, kb):
+        """Called by KnowledgeBase.load once a saturated KB is restored; its
+            rules only need to be joined against facts added from now on
+
+        Args:
+            kb (KnowledgeBase) - the restored KnowledgeBase
+        """
+        self.rules.extend(rule for rule in kb.rules.active() if rule.lhs)
+
+    def fact_removed(self, fact, kb):
+        """Called by the KB after a fact is removed
+
+        Args:
+            fact (Fact) - the removed fact
+            kb (KnowledgeBase) - the KnowledgeBase it was removed from
+        """
+        self.delta.pop(fact, None)
+
+    def rule_removed(self, rule, kb):
+        """Called by the KB after a rule is removed
+
+        Args:
+            rule (Rule) - the removed rule
+            kb (KnowledgeBase) - the KnowledgeBase it was removed from
+        """
+        for rules in (self.rules, self.new_rules):
+            if rule in rules:
+                rules.remove(rule)
+
+    def _join(self, kb, rule, order, delta_position, delta, bindings, facts, derived):
+        """INTERNAL USE ONLY
+        Join the antecedents of rule listed in order, depth first. The
+            antecedent at delta_position only takes delta facts, earlier ones
+            only take old facts and later ones take any fact; delta_position
+            None takes any fact everywhere. This produces each combination
+            exactly once. facts holds the fact chosen for every antecedent.
+        """
+        if not order:
+            derived.append((tuple(facts), bindings, rule))
+            return
+        i = order[0]
+        pattern = Statement.from_ids(instantiate_ids(rule.lhs[i].ids, bindings))
+        if i == delta_position:
+            candidates = delta
+        else:
+            candidates = list(kb.facts.candidates(pattern))
+        for fact in candidates:
+            if delta_position is not None and i < delta_position and fact in delta:
+                continue
+            merged = dict(bindings)
+            matched = match_ids(pattern.ids, fact.statement.ids, merged)
+            if kb.stats is not None:
+                kb.stats.matched(rule, matched)
+            if not matched:
+                continue
+            facts[i] = fact
+            self._join(kb, rule, order[1:], delta_position, delta, merged, facts, derived)
+        facts[i] = None
@@ -1,13 +1,48 @@
-import read, copy
+import read, copy, itertools, array, mmap, struct, sys, weakref
 from util import *
 from logical_classes import *
+from backward import TabledProver
 verbose = 0
 
 class KnowledgeBase(object):
-    def __init__(self, facts=[], rules=[]):
-        self.facts = facts
-        self.rules = rules
-        self.ie = InferenceEngine()
+    def __init__(self, facts=[], rules=[], ie=None, agenda=None, cache_size=256,
+                 backward=False, instrument=False, threadsafe=False):
+        self.facts = IndexedList(facts, lambda fact: fact.statement)
+        self.rules = IndexedList(rules, lambda rule: rule.lhs[0] if rule.lhs else None)
+        # justifications of inferred facts and rules, indexed both ways
+        self.support = SupportGraph()
+        for fact_rule in list(self.facts) + list(self.rules):
+            self.support.attach(fact_rule, add_pending=False)
+        for fact_rule in list(self.facts) + list(self.rules):
+            self.support.add_pending(fact_rule)
+        # inference engine, e.g. rete.ReteEngine(); defaults to rule currying
+        self.ie = ie if ie is not None else InferenceEngine()
+        # facts and rules stored but not yet passed to the inference engine,
+        # e.g. Agenda('lifo'); defaults to FIFO
+        self.agenda = agenda if agenda is not None else Agenda()
+        # kb_ask answers, invalidated by predicate as facts come and go
+        self.cache = QueryCache(cache_size, threadsafe)
+        # predicates proved on demand by backward chaining instead of being
+        # materialized: True for all of them, or a set of predicate ids
+        if backward is True:
+            self.backward = True
+        else:
+            self.backward = set(SYMBOLS.intern(p) for p in backward or ())
+        self.prover = TabledProver(self, threadsafe)
+        if self.backward:
+            self._spread_backward()
+        # counters, timers and tracing callbacks, None when not instrumented
+        self.stats = Instrumentation() if instrument else None
+        # lets queries run in parallel while writers run alone, None when
+        # the KB is only used from one thread
+        self.lock = ReadWriteLock() if threadsafe else None
+        # bumped whenever facts become visible or are removed; removed facts
+        # are kept by predicate id as (born, removed, fact) version stamps
+        # while older snapshots live, since a fact re-asserted later is
+        # stamped again
+        self.version = 0
+        self.history = {}
+        self.snapshots = weakref.WeakSet()
 
     def __repr__(self):
         return 'KnowledgeBase({!r}, {!r})'.format(self.facts, self.rules)
@@ -18,6 +53,40 @@ class KnowledgeBase(object):
         string += "\n".join((str(rule) for rule in self.rules))
         return string
 
+    def snapshot(self):
+        """Get a frozen view of the facts, e.g. for a long scan while the KB
+            keeps changing. Nothing is copied: facts carry the version they
+            appeared at, and facts removed later are kept aside until every
+            older snapshot is closed. Snapshots garbage collected without
+            close() only release them at a retraction made once no snapshot
+            is left.
+
+        Returns:
+            Snapshot: view of the facts as of now
+        """
+        with self.reading():
+            snapshot = Snapshot(self)
+            self.snapshots.add(snapshot)
+            return snapshot
+
+    def reading(self):
+        """Context manager holding the KB for reading; queries made inside
+            it all see the same state. Without threadsafe=True it does nothing.
+
+        Returns:
+            context manager
+        """
+        return self.lock.read() if self.lock is not None else NO_LOCK
+
+    def writing(self):
+        """Context manager holding the KB for writing, excluding every other
+            reader and writer. Without threadsafe=True it does nothing.
+
+        Returns:
+            context manager
+        """
+        return self.lock.write() if self.lock is not None else NO_LOCK
+
     def _get_fact(self, fact):
         """INTERNAL USE ONLY
         Get the fact in the KB that is the same as the fact argument
@@ -28,9 +97,7 @@ class KnowledgeBase(object):
         Returns:
             Fact: matching fact
         """
-        for kbfact in self.facts:
-            if fact == kbfact:
-                return kbfact
+        return self.facts.get(fact)
 
     def _get_rule(self, rule):
         """INTERNAL USE ONLY
@@ -42,9 +109,7 @@ class KnowledgeBase(object):
         Returns:
             Rule: matching rule
         """
-        for kbrule in self.rules:
-            if rule == kbrule:
-                return kbrule
+        return self.rules.get(rule)
 
     def kb_add(self, fact_rule):
         """Add a fact or rule to the KB
@@ -53,33 +118,132 @@ class KnowledgeBase(object):
         Returns:
             None
         """
-        printv("Adding {!r}", 1, verbose, [fact_rule])
-        if isinstance(fact_rule, Fact):
-            if fact_rule not in self.facts:
-                self.facts.append(fact_rule)
-                for rule in self.rules:
-                    self.ie.fc_infer(fact_rule, rule, self)
-            else:
-                if fact_rule.supported_by:
-                    ind = self.facts.index(fact_rule)
-                    for f in fact_rule.supported_by:
-                        self.facts[ind].supported_by.append(f)
+        with self.writing():
+            printv("Adding {!r}", 1, verbose, [fact_rule])
+            stats = self.stats
+            if isinstance(fact_rule, Fact):
+                kbfact = self._get_fact(fact_rule)
+                if kbfact is None:
+                    self.support.attach(fact_rule)
+                    if stats is not None and fact_rule.supported_by:
+                        stats.derived(fact_rule)
+                    self.facts.append(fact_rule, activate=False)
+                    self.agenda.push(fact_rule)
                 else:
-                    ind = self.facts.index(fact_rule)
-                    self.facts[ind].asserted = True
-        elif isinstance(fact_rule, Rule):
-            if fact_rule not in self.rules:
-                self.rules.append(fact_rule)
-                for fact in self.facts:
-                    self.ie.fc_infer(fact, fact_rule, self)
-            else:
-                if fact_rule.supported_by:
-                    ind = self.rules.index(fact_rule)
-                    for f in fact_rule.supported_by:
-                        self.rules[ind].supported_by.append(f)
+                    if fact_rule.supported_by:
+                        if stats is not None:
+                            stats.emit('duplicate_derivations', item=kbfact,
+                                       supported_by=fact_rule.supported_by)
+                        for f in fact_rule.supported_by:
+                            self.support.add(kbfact, f)
+                    else:
+                        kbfact.asserted = True
+            elif isinstance(fact_rule, Rule):
+                kbrule = self._get_rule(fact_rule)
+                if kbrule is None:
+                    self.support.attach(fact_rule)
+                    if stats is not None and fact_rule.supported_by:
+                        stats.derived(fact_rule)
+                    self.rules.append(fact_rule, activate=False)
+                    self.agenda.push(fact_rule)
                 else:
-                    ind = self.rules.index(fact_rule)
-                    self.rules[ind].asserted = True
+                    if fact_rule.supported_by:
+                        if stats is not None:
+                            stats.emit('duplicate_derivations', item=kbrule,
+                                       supported_by=fact_rule.supported_by)
+                        for f in fact_rule.supported_by:
+                            self.support.add(kbrule, f)
+                    else:
+                        kbrule.asserted = True
+            self.run_agenda()
+
+    def run_agenda(self):
+        """Pass pending facts and rules to the inference engine until the
+            agenda is empty. Inferences made meanwhile are queued rather than
+            processed recursively, so a nested call returns immediately.
+            A pending item only becomes visible to candidates() when it is
+            processed, so every fact/rule pair is tried exactly once.
+        """
+        if self.agenda.running:
+            return
+        self.agenda.running = True
+        stats = self.stats
+        start = stats.start() if stats is not None else None
+        try:
+            while self.agenda:
+                while self.agenda:
+                    item = self.agenda.pop()
+                    if isinstance(item, Fact):
+                        if self._get_fact(item) is not item:
+                            continue
+                        self.version += 1
+                        item.born = self.version
+                        self.facts.activate(item)
+                        self.cache.invalidate(item.statement.ids[0])
+                        self.prover.clear()
+                        self.ie.fact_added(item, self)
+                    else:
+                        if self._get_rule(item) is not item:
+                            continue
+                        if self._backward_rule(item):
+                            # kept out of the engine, used by kb_ask only
+                            self.prover.add_rule(item)
+                            continue
+                        self.rules.activate(item)
+                        self.ie.rule_added(item, self)
+                # engines that work in rounds may queue more items here
+                self.ie.agenda_empty(self)
+        finally:
+            self.agenda.running = False
+            if stats is not None:
+                stats.stop('inference', start)
+
+    def is_backward(self, predicate):
+        """Check whether a predicate is proved by backward chaining
+
+        Args:
+            predicate (int): predicate symbol id
+
+        Returns:
+            bool
+        """
+        return self.backward is True or predicate in self.backward
+
+    def _backward_rule(self, rule):
+        """INTERNAL USE ONLY
+        Check whether a rule concludes a backward predicate. A rule depending
+            on a backward predicate never fires forward, so its conclusion
+            becomes a backward predicate as well.
+        """
+        if not rule.lhs:
+            return False
+        if self.is_backward(rule.rhs.ids[0]):
+            return True
+        if any(self.is_backward(s.ids[0]) for s in rule.lhs):
+            self.backward.add(rule.rhs.ids[0])
+            self._spread_backward()
+            return True
+        return False
+
+    def _spread_backward(self):
+        """INTERNAL USE ONLY
+        Move the active rules that conclude or use a backward predicate from
+            the engine to the prover, until no rule is left to move, so which
+            predicates are backward does not depend on the order rules came in
+        """
+        moved = True
+        while moved:
+            moved = False
+            for rule in list(self.rules.active()):
+                if not (self.is_backward(rule.rhs.ids[0]) or
+                        any(self.is_backward(s.ids[0]) for s in rule.lhs)):
+                    continue
+                if self.backward is not True:
+                    self.backward.add(rule.rhs.ids[0])
+                self.rules.deactivate(rule)
+                self.ie.rule_removed(rule, self)
+                self.prover.add_rule(rule)
+                moved = True
 
     def kb_assert(self, fact_rule):
         """Assert a fact or rule into the KB
@@ -88,7 +252,39 @@ class KnowledgeBase(object):
             fact_rule (Fact or Rule): Fact or Rule we're asserting
         """
         printv("Asserting {!r}", 0, verbose, [fact_rule])
-        self.kb_add(fact_rule)
+        with self.writing():
+            stats = self.stats
+            # inferences are asserted too, only time calls from outside
+            start = stats.start() if stats is not None and not self.agenda.running else None
+            self.kb_add(fact_rule)
+            if start is not None:
+                stats.stop('assert', start)
+
+    def kb_assert_many(self, facts_rules):
+        """Assert many facts and rules, e.g. the output of read.read_tokenize,
+            deferring inference until all of them are stored. Every item then
+            goes through the agenda once and is only joined against items
+            processed before it, so no fact/rule pair is matched twice.
+
+        Args:
+            facts_rules (iterable of Fact|Rule): Facts and Rules to assert;
+                anything else (e.g. parsed comments) is skipped
+        """
+        with self.writing():
+            stats = self.stats
+            start = stats.start() if stats is not None and not self.agenda.running else None
+            running = self.agenda.running
+            self.agenda.running = True
+            try:
+                for fact_rule in facts_rules:
+                    if isinstance(fact_rule, Fact) or isinstance(fact_rule, Rule):
+                        printv("Asserting {!r}", 0, verbose, [fact_rule])
+                        self.kb_add(fact_rule)
+            finally:
+                self.agenda.running = running
+            self.run_agenda()
+            if start is not None:
+                stats.stop('assert', start)
 
     def kb_ask(self, fact):
         """Ask if a fact is in the KB
@@ -99,21 +295,192 @@ class KnowledgeBase(object):
         Returns:
             listof Bindings|False - list of Bindings if result found, False otherwise
         """
-        print("Asking {!r}".format(fact))
-        if factq(fact):
-            f = Fact(fact.statement)
-            bindings_lst = ListOfBindings()
-            # ask matched facts
-            for fact in self.facts:
-                binding = match(f.statement, fact.statement)
-                if binding:
-                    bindings_lst.add_bindings(binding, [fact])
+        with self.reading():
+            print("Asking {!r}".format(fact))
+            if factq(fact):
+                stats = self.stats
+                start = stats.start() if stats is not None else None
+                key, variables = QueryCache.canonical(fact.statement)
+                if self.is_backward(key[0]):
+                    # the prover's tables cache these answers
+                    answer = list(self._matches(key))
+                else:
+                    answer = self.cache.get(key)
+                    if answer is None:
+                        answer = list(self._matches(key))
+                        self.cache.put(key, answer)
+                rename = self._renaming(variables)
+                bindings_lst = ListOfBindings()
+                for bound, kbfact in answer:
+                    bindings_lst.add_bindings(self._bindings(bound, rename), [kbfact])
+                if stats is not None:
+                    stats.stop('ask', start)
+
+                return bindings_lst if bindings_lst.list_of_bindings else []
 
-            return bindings_lst if bindings_lst.list_of_bindings else []
+            else:
+                print("Invalid ask:", fact.statement)
+                return []
 
-        else:
+    def kb_ask_iter(self, fact, limit=None, exists_only=False, count_only=False):
+        """Ask a fact lazily, without building a ListOfBindings. Matches are
+            found as the result is consumed (or served from the query cache),
+            so asking for one answer only visits facts up to the first match.
+            The KB must not change while the result is being iterated.
+
+        Args:
+            fact (Fact) - Statement to be asked
+            limit (int|None) - stop after this many answers
+            exists_only (bool) - return whether there is an answer
+            count_only (bool) - return the number of answers
+
+        Returns:
+            iterator of Bindings|bool|int - Bindings of each answer; a bool if
+                exists_only; an int if count_only. No Bindings are built for
+                the last two.
+        """
+        printv("Asking {!r}", 0, verbose, [fact])
+        if not factq(fact):
             print("Invalid ask:", fact.statement)
-            return []
+            return False if exists_only else 0 if count_only else iter([])
+        if self.lock is not None:
+            # answer while holding the lock, a lazy iterator would outlive it
+            with self.reading():
+                answer = self._ask_iter(fact, limit, exists_only, count_only)
+                return answer if exists_only or count_only else iter(list(answer))
+        return self._ask_iter(fact, limit, exists_only, count_only)
+
+    def _ask_iter(self, fact, limit, exists_only, count_only):
+        """INTERNAL USE ONLY
+        Answer a valid kb_ask_iter query
+        """
+        key, variables = QueryCache.canonical(fact.statement)
+        # lazy answers are not cached, so a miss here is not counted either
+        answer = None if self.is_backward(key[0]) else self.cache.get(key, count_miss=False)
+        answer = iter(answer) if answer is not None else self._matches(key)
+        if limit is not None:
+            answer = itertools.islice(answer, limit)
+        if exists_only:
+            return next(answer, None) is not None
+        if count_only:
+            return sum(1 for _ in answer)
+        rename = self._renaming(variables)
+        return (self._bindings(bound, rename) for bound, kbfact in answer)
+
+    def kb_query(self, statements):
+        """Answer a conjunctive query directly from the fact indexes, without
+            asserting a temporary rule. Patterns are joined most selective
+            first (fewest candidate facts), preferring patterns that share a
+            variable with those already joined; each join is a hash join on
+            the shared variables.
+
+        Args:
+            statements (listof Fact|Statement) - patterns that must all hold
+
+        Returns:
+            ListOfBindings|[] - one row per answer, with the bindings of every
+                variable and the facts matching each pattern, in the order
+                given; [] if there is no answer
+        """
+        with self.reading():
+            printv("Querying {!r}", 0, verbose, [statements])
+            stats = self.stats
+            start = stats.start() if stats is not None else None
+            patterns = [s.statement if isinstance(s, Fact) else s for s in statements]
+            estimates = [len(self.prover.answers(p)) if self.is_backward(p.ids[0])
+                         else self.facts.estimate(p) for p in patterns]
+            rows = self._join(patterns, estimates, self._candidates)
+            bindings_lst = ListOfBindings()
+            for bindings, facts in rows:
+                bindings_lst.add_bindings(Bindings.from_ids(bindings), facts)
+            if stats is not None:
+                stats.stop('query', start)
+            return bindings_lst if bindings_lst.list_of_bindings else []
+
+    def _join(self, patterns, estimates, candidates):
+        """INTERNAL USE ONLY
+        Hash-join patterns most selective first, see kb_query
+
+        Args:
+            patterns (listof Statement): query patterns
+            estimates (listof int): estimated candidates of each pattern
+            candidates (function): Statement => facts that may match it
+
+        Returns:
+            listof (dictof int, listof Fact): bindings and matched facts of
+                every answer
+        """
+        variable = SYMBOLS.variable
+        remaining = list(range(len(patterns)))
+        # rows of (bindings, facts per pattern), starting from the empty row
+        rows = [({}, [None] * len(patterns))]
+        seen = set()
+        while remaining and rows:
+            i = min(remaining, key=lambda i: (
+                not seen.intersection(patterns[i].ids[1:]) and bool(seen),
+                estimates[i]))
+            remaining.remove(i)
+            pattern = patterns[i]
+            shared = [v for v in pattern.ids[1:] if variable[v] and v in seen]
+            # build side: facts matching the pattern, by their shared values
+            table = {}
+            for fact in candidates(pattern):
+                bound = {}
+                if match_ids(pattern.ids, fact.statement.ids, bound):
+                    table.setdefault(tuple(bound[v] for v in shared), []).append((bound, fact))
+            # probe side: the rows joined so far
+            joined = []
+            for bindings, facts in rows:
+                for bound, fact in table.get(tuple(bindings[v] for v in shared), ()):
+                    merged = dict(bindings)
+                    merged.update(bound)
+                    row_facts = list(facts)
+                    row_facts[i] = fact
+                    joined.append((merged, row_facts))
+            rows = joined
+            seen.update(v for v in pattern.ids[1:] if variable[v])
+        return rows
+
+    def _matches(self, key, candidates=None):
+        """INTERNAL USE ONLY
+        Generate the facts matching a canonical query, only visiting facts
+            whose predicate, arity and bound arguments agree with it
+
+        Args:
+            key (tuple of int): canonical query ids, see QueryCache.canonical
+            candidates (function|None): Statement => facts that may match it,
+                defaults to _candidates
+
+        Yields:
+            (dictof int, Fact): bindings of the query's placeholders and the
+                matched fact
+        """
+        candidates = candidates or self._candidates
+        for kbfact in candidates(Statement.from_ids(key)):
+            bound = {}
+            if match_ids(key, kbfact.statement.ids, bound):
+                yield bound, kbfact
+
+    def _candidates(self, statement):
+        """INTERNAL USE ONLY
+        Get the facts that may match statement: stored candidates, or the
+            answers proved by the TabledProver for a backward predicate
+        """
+        if self.is_backward(statement.ids[0]):
+            return self.prover.answers(statement)
+        return self.facts.candidates(statement)
+
+    def _renaming(self, variables):
+        """INTERNAL USE ONLY
+        Map the placeholders of a canonical query back to the query's variables
+        """
+        return dict((QueryCache.placeholder(i), v) for i, v in enumerate(variables))
+
+    def _bindings(self, bound, rename):
+        """INTERNAL USE ONLY
+        Build the Bindings of one match of a canonical query
+        """
+        return Bindings.from_ids(dict((rename.get(k, k), v) for k, v in bound.items()))
 
     def kb_retract(self, fact_or_rule):
         """Retract a fact from the KB
@@ -125,88 +492,460 @@ class KnowledgeBase(object):
             None
         """
         printv("Retracting {!r}", 0, verbose, [fact_or_rule])
-        ####################################################
-        # Student code goes here
+        self.kb_retract_many([fact_or_rule])
+
+    def kb_retract_many(self, facts):
+        """Retract many facts from the KB in one pass. Supported facts are only
+            marked as no longer asserted; the others are removed together with
+            every unasserted fact and rule left without a justification. Rules
+            cannot be retracted and are skipped.
+
+        Args:
+            facts (iterable of Fact) - Facts to be retracted
 
-        if isinstance(fact_or_rule, Fact):
-            if fact_or_rule in self.facts:
-                # get the actual fact_or_rule from the KB
-                fact_or_rule = self._get_fact(fact_or_rule)
-                # use that fact to run the helper function
-                self.kb_helper(fact_or_rule)
+        Returns:
+            None
+        """
+        with self.writing():
+            stats = self.stats
+            start = stats.start() if stats is not None else None
+            unsupported = []
+            for fact in facts:
+                if not factq(fact):
+                    continue
+                # get the actual fact from the KB
+                fact = self._get_fact(fact)
+                if fact is None:
+                    continue
+                if self.support.supported(fact):
+                    # supported facts stay, they are just no longer asserted
+                    fact.asserted = False
+                else:
+                    unsupported.append(fact)
+            # unassert everything first, so a fact retracted in this batch is
+            # removed if it also loses its justifications below
+            self._sweep(unsupported)
+            if stats is not None:
+                stats.stop('retract', start)
 
-    # helper function to handle all the different cases of fact
-    # and recursively call for facts and rules that need to be assessed as a result of removing initial fact
     def kb_helper(self, fact_or_rule):
-        if isinstance(fact_or_rule, Fact):
-            # must be fact
-            if len(fact_or_rule.supported_by) == 0:
-                # un-supported fact
-                # remove regardless of asserted or not
-                # for every fact in the supports facts list
-                # for every fact, rule pair in the supported by list fro that fact
-                # if the fact_or_rule is in this tuple [fact, rule],
-                # remove this tuple from the supported by list
-                for f in fact_or_rule.supports_facts:
-                    for fr in f.supported_by:
-                        if fact_or_rule in fr:
-                            f.supported_by.remove(fr)
-                    # recursively call helper function for all facts in supports_facts
-                    self.kb_helper(f)
-
-                # same logic as above, but for rules instead
-                for r in fact_or_rule.supports_rules:
-                    for rr in r.supported_by:
-                        if fact_or_rule in rr:
-                            r.supported_by.remove(rr)
-                    # recursively call helper function for all rules in supports_rules
-                    self.kb_helper(r)
-
-                    # finally remove the fact_or_rule from the KB
-                self.facts.remove(fact_or_rule)
+        """INTERNAL USE ONLY
+        Remove an unsupported fact or rule from the KB along with every
+            unasserted fact and rule that loses its last justification as a
+            result
+
+        Args:
+            fact_or_rule (Fact|Rule): fact or rule stored in the KB
+        """
+        with self.writing():
+            self._sweep([fact_or_rule])
+
+    def _sweep(self, unsupported):
+        """INTERNAL USE ONLY
+        Mark-and-sweep truth maintenance. Starting from items to remove, drop
+            each justification they take part in using a worklist; a dependent
+            whose support_count (live justifications) reaches zero and that is
+            not asserted is marked as well. Marked items are removed in one sweep.
+            Each justification is visited once, whatever the depth of the
+            dependency chains.
+
+        Args:
+            unsupported (listof Fact|Rule): items stored in the KB to remove
+        """
+        support = self.support
+        marked = dict.fromkeys(unsupported)
+        worklist = list(marked)
+        while worklist:
+            item = worklist.pop()
+            for derived in support.retract(item):
+                if (derived not in marked and not derived.asserted
+                        and not support.supported(derived)):
+                    marked[derived] = None
+                    worklist.append(derived)
+        printv("Removing {!r} facts and rules", 1, verbose, [len(marked)])
+        if self.stats is not None:
+            self.stats.cascades.append(len(marked))
+            self.stats.counters['retracted_items'] += len(marked)
+            self.stats.emit('retractions', removed=list(marked))
+            for item in marked:
+                self.stats.roots.pop(item, None)
+        self.version += 1
+        if not self.snapshots:
+            self.history.clear()
+        for item in marked:
+            support.detach(item)
+            if isinstance(item, Fact):
+                if self.snapshots:
+                    self.history.setdefault(item.statement.ids[0], []).append(
+                        (item.born, self.version, item))
+                self.facts.remove(item)
+                self.cache.invalidate(item.statement.ids[0])
+                self.prover.clear()
+                self.ie.fact_removed(item, self)
             else:
-                # supported fact
-                if fact_or_rule.asserted:
-                    # asserted and supported
-                    fact_or_rule.asserted = False
-                # else it is un-asserted, but supported fact
-                # do nothing
-        else:
-            # must be rule
-            # get kbrule from kb
-            fact_or_rule = self._get_rule(fact_or_rule)
-            if not fact_or_rule.asserted:
-                # un-asserted rule
-                if len(fact_or_rule.supported_by) == 0:
-                    # un-supported
-                    # use same logic as above to remove from KB
-                    for f in fact_or_rule.supports_facts:
-                        for fr in f.supported_by:
-                            if fact_or_rule in fr:
-                                f.supported_by.remove(fr)
-                        # recursively call helper function for all facts in supports_facts
-                        self.kb_helper(f)
-
-                    for r in fact_or_rule.supports_rules:
-                        for rr in r.supported_by:
-                            if fact_or_rule in rr:
-                                r.supported_by.remove(rr)
-                        # recursively call helper function for all rules in supports_rules
-                        self.kb_helper(r)
-
-                        # finally remove the rule from the KB
-                    self.rules.remove(fact_or_rule)
+                self.rules.remove(item)
+                self.prover.remove_rule(item)
+                self.ie.rule_removed(item, self)
+
+    # magic number of a KnowledgeBase.save file, followed by four sections
+    SNAPSHOT_MAGIC = b"KBSNAP01"
+
+    def save(self, path):
+        """Write the KB to a compact binary snapshot, see KnowledgeBase.load.
+            It holds the names of the symbols used, every fact and rule with its
+            asserted flag and activation order, the justification graph and
+            the backward predicates. Each section is an int64 byte length
+            followed by little-endian int64 arrays (names are NUL-separated
+            UTF-8). Items are numbered facts first, then rules, in KB order.
+
+        Args:
+            path (str): file to write
+        """
+        with self.reading():
+            printv("Saving {!r} facts and {!r} rules", 0, verbose,
+                [len(self.facts), len(self.rules)])
+            names = {}
+            def encode(statement, out):
+                out.append(len(statement.ids))
+                out.extend(names.setdefault(i, len(names)) for i in statement.ids)
+            items = list(self.facts) + list(self.rules)
+            index = dict((item.id, n) for n, item in enumerate(items))
+            table = array.array('q')
+            for item in items:
+                is_fact = isinstance(item, Fact)
+                ranks = (self.facts if is_fact else self.rules).statements.seq
+                table.extend((0 if is_fact else 1, int(item.asserted), ranks.get(item, -1)))
+                if is_fact:
+                    encode(item.statement, table)
                 else:
-                    # un-asserted supported
-                    # do nothing
-                    return None
+                    table.append(len(item.lhs))
+                    for statement in item.lhs + [item.rhs]:
+                        encode(statement, table)
+            justifications = array.array('q')
+            for n, item in enumerate(items):
+                for ids in self.support._justifications(item.id):
+                    justifications.extend((n, len(ids)))
+                    justifications.extend(index[i] for i in ids)
+            backward = array.array('q', [-1] if self.backward is True else
+                                   [names.setdefault(i, len(names)) for i in self.backward])
+            if sys.byteorder == "big":
+                for section in (table, justifications, backward):
+                    section.byteswap()
+            symbol_names = sorted(names, key=names.get)
+            sections = [b"\0".join(SYMBOLS.names[i].encode("utf-8") for i in symbol_names),
+                        backward.tobytes(), table.tobytes(), justifications.tobytes()]
+            with open(path, "wb") as f:
+                f.write(KnowledgeBase.SNAPSHOT_MAGIC)
+                for section in sections:
+                    f.write(struct.pack("<q", len(section)))
+                    f.write(section)
+
+    @classmethod
+    def load(cls, path, ie=None, agenda=None, cache_size=256):
+        """Restore a KB written by KnowledgeBase.save. The file is memory
+            mapped and its int64 sections are decoded in place from the map,
+            without copying them; facts, rules and their justifications are
+            stored directly, without running inference.
+            The engine is then told through its kb_loaded hook.
+
+        Args:
+            path (str): file to read
+            ie, agenda, cache_size: as for KnowledgeBase()
+
+        Returns:
+            KnowledgeBase: the restored KB
+
+        Raises:
+            ValueError: if path is not a KB snapshot
+        """
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[0:8] != KnowledgeBase.SNAPSHOT_MAGIC:
+                    raise ValueError("Not a KnowledgeBase snapshot: {!r}".format(path))
+                # sections are read in place; every view must be released
+                # before the map closes
+                views = [memoryview(data)]
+                try:
+                    offset = 8
+                    for n in range(4):
+                        if offset + 8 > len(data):
+                            raise ValueError("Truncated KnowledgeBase snapshot: {!r}".format(path))
+                        size, = struct.unpack_from("<q", data, offset)
+                        if size < 0 or offset + 8 + size > len(data) or (n and size % 8):
+                            raise ValueError("Truncated KnowledgeBase snapshot: {!r}".format(path))
+                        views.append(views[0][offset + 8:offset + 8 + size])
+                        offset += 8 + size
+                    names = views[1].tobytes()
+                    symbols = [SYMBOLS.intern(name.decode("utf-8"))
+                               for name in names.split(b"\0")] if names else []
+                    arrays = [cls._int64s(view) for view in views[2:]]
+                    views.extend(a for a in arrays if isinstance(a, memoryview))
+                    return cls._restore(symbols, *arrays, ie=ie, agenda=agenda,
+                                        cache_size=cache_size)
+                finally:
+                    for view in reversed(views):
+                        view.release()
+
+    @staticmethod
+    def _int64s(view):
+        """INTERNAL USE ONLY
+        Read a little-endian int64 section in place, copying it only on
+            big-endian machines
+        """
+        if sys.byteorder == "big":
+            values = array.array('q')
+            values.frombytes(view)
+            values.byteswap()
+            return values
+        return view.cast('q')
+
+    @classmethod
+    def _restore(cls, symbols, backward, table, justifications, ie, agenda, cache_size):
+        """INTERNAL USE ONLY
+        Build a KB from the decoded sections of a snapshot, see load
+        """
+        kb = cls([], [], ie, agenda, cache_size,
+                 True if list(backward) == [-1] else [SYMBOLS.names[symbols[i]] for i in backward])
+        items = []
+        ranked = []
+        symbol = symbols.__getitem__
+        from_ids = Statement.from_ids
+        i = 0
+        while i < len(table):
+            kind, asserted, rank, n = table[i:i + 4]
+            i += 4
+            if kind == 0:
+                item = Fact(from_ids(tuple(map(symbol, table[i:i + n]))))
+                i += n
+                kb.facts.append(item, activate=False)
             else:
-                # asserted rule
-                # do nothing
-                return None
+                # n is the number of LHS statements, then comes the RHS
+                statements = []
+                for _ in range(n + 1):
+                    size = table[i]
+                    statements.append(from_ids(tuple(map(symbol, table[i + 1:i + 1 + size]))))
+                    i += 1 + size
+                item = Rule([statements[:-1], statements[-1]])
+                kb.rules.append(item, activate=False)
+            item.asserted = bool(asserted)
+            kb.support.attach(item, add_pending=False)
+            items.append(item)
+            ranked.append((kind, rank, len(ranked)))
+        # activate in the saved order, so candidates() come out as before
+        ranked.sort()
+        for kind, rank, n in ranked:
+            item = items[n]
+            if kind == 0:
+                kb.facts.activate(item)
+            elif rank >= 0:
+                kb.rules.activate(item)
+            elif kb._backward_rule(item):
+                kb.prover.add_rule(item)
+        add = kb.support.add
+        i = 0
+        while i < len(justifications):
+            derived, n = justifications[i:i + 2]
+            add(items[derived], [items[j] for j in justifications[i + 2:i + 2 + n]])
+            i += 2 + n
+        kb.ie.kb_loaded(kb)
+        return kb
+
+
+class Snapshot(object):
+    """Immutable view of the facts of a KnowledgeBase at one version, see
+        KnowledgeBase.snapshot. Answers only include facts visible at that
+        version, even after they are retracted from the KB. Only membership is
+        versioned: asserted flags and justifications are those of the live KB,
+        and facts removed since have none. Backward predicates cannot be
+        asked, they are proved against the live KB.
+
+    Attributes:
+        kb (KnowledgeBase): KB this is a view of
+        version (int): KB version frozen by this view
+    """
+    def __init__(self, kb):
+        """Constructor for Snapshot, use KnowledgeBase.snapshot instead
+
+        Args:
+            kb (KnowledgeBase): KB to freeze
+        """
+        super(Snapshot, self).__init__()
+        self.kb = kb
+        self.version = kb.version
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Snapshot({!r})'.format(self.version)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        """Iterate over the visible facts in the order they appeared
+        """
+        kb = self.kb
+        with kb.reading():
+            found = [(f.born, f) for f in kb.facts.active() if f.born <= self.version]
+            found.extend(self._removed(itertools.chain(*kb.history.values())))
+        found.sort(key=lambda entry: entry[0])
+        return iter([fact for _, fact in found])
+
+    def __len__(self):
+        """Number of visible facts
+        """
+        return sum(1 for _ in self)
+
+    def close(self):
+        """Release the retracted facts only this snapshot still needed
+        """
+        kb = self.kb
+        with kb.writing():
+            kb.snapshots.discard(self)
+            oldest = min((s.version for s in kb.snapshots), default=None)
+            for predicate in list(kb.history):
+                kept = [entry for entry in kb.history[predicate]
+                        if oldest is not None and entry[1] > oldest]
+                if kept:
+                    kb.history[predicate] = kept
+                else:
+                    del kb.history[predicate]
+
+    def kb_ask(self, fact):
+        """Ask a fact as of this snapshot, see KnowledgeBase.kb_ask
+
+        Args:
+            fact (Fact) - Statement to be asked
+
+        Returns:
+            ListOfBindings|[] - list of Bindings if result found, [] otherwise
+        """
+        kb = self.kb
+        bindings_lst = ListOfBindings()
+        key, variables = QueryCache.canonical(fact.statement)
+        rename = kb._renaming(variables)
+        for bound, kbfact in kb._matches(key, self._candidates):
+            bindings_lst.add_bindings(kb._bindings(bound, rename), [kbfact])
+        return bindings_lst if bindings_lst.list_of_bindings else []
+
+    def kb_ask_iter(self, fact, limit=None, exists_only=False, count_only=False):
+        """Ask a fact lazily as of this snapshot, see KnowledgeBase.kb_ask_iter.
+            The KB may change while the result is iterated.
+        """
+        kb = self.kb
+        key, variables = QueryCache.canonical(fact.statement)
+        answer = kb._matches(key, self._candidates)
+        if limit is not None:
+            answer = itertools.islice(answer, limit)
+        if exists_only:
+            return next(answer, None) is not None
+        if count_only:
+            return sum(1 for _ in answer)
+        rename = kb._renaming(variables)
+        return (kb._bindings(bound, rename) for bound, kbfact in answer)
+
+    def kb_query(self, statements):
+        """Answer a conjunctive query as of this snapshot, see
+            KnowledgeBase.kb_query
+        """
+        patterns = [s.statement if isinstance(s, Fact) else s for s in statements]
+        with self.kb.reading():
+            estimates = [self.kb.facts.estimate(p) for p in patterns]
+        rows = self.kb._join(patterns, estimates, self._candidates)
+        bindings_lst = ListOfBindings()
+        for bindings, facts in rows:
+            bindings_lst.add_bindings(Bindings.from_ids(bindings), facts)
+        return bindings_lst if bindings_lst.list_of_bindings else []
+
+    def _candidates(self, statement):
+        """INTERNAL USE ONLY
+        Get the facts visible in this snapshot that may match statement, in
+            the order they appeared
+        """
+        kb = self.kb
+        if kb.is_backward(statement.ids[0]):
+            raise ValueError("Backward predicates cannot be asked from a snapshot")
+        with kb.reading():
+            facts = [f for f in kb.facts.candidates(statement) if f.born <= self.version]
+            removed = self._removed(kb.history.get(statement.ids[0], ()))
+        if not removed:
+            return facts
+        found = [(f.born, f) for f in facts] + removed
+        found.sort(key=lambda entry: entry[0])
+        return [fact for _, fact in found]
+
+    def _removed(self, history):
+        """INTERNAL USE ONLY
+        Get (born, fact) for the (born, removed, fact) history entries that
+            were visible in this snapshot and removed after it
+        """
+        return [(born, fact) for born, removed, fact in history
+                if born <= self.version < removed]
 
 
 class InferenceEngine(object):
+    """Forward-chaining engine that curries rules: matching a fact against the
+        first LHS statement of a rule infers either a fact or a new, shorter
+        rule. The KnowledgeBase notifies its engine through the *_added and
+        *_removed hooks; other engines (see rete.py) implement the same hooks.
+    """
+    def fact_added(self, fact, kb):
+        """Called by the KB after a new fact is stored
+
+        Args:
+            fact (Fact) - the new fact
+            kb (KnowledgeBase) - the KnowledgeBase it was added to
+        """
+        # only rules whose first LHS statement can match fire; iterate over a
+        # copy, rules inferred below are matched against fact when they are
+        # added themselves
+        stats = kb.stats
+        for rule in list(kb.rules.candidates(fact.statement)):
+            start = stats.start() if stats is not None else None
+            self.fc_infer(fact, rule, kb)
+            if stats is not None:
+                stats.charge(rule, start)
+
+    def rule_added(self, rule, kb):
+        """Called by the KB after a new rule is stored
+
+        Args:
+            rule (Rule) - the new rule
+            kb (KnowledgeBase) - the KnowledgeBase it was added to
+        """
+        if not rule.lhs:
+            return
+        stats = kb.stats
+        for fact in list(kb.facts.candidates(rule.lhs[0])):
+            start = stats.start() if stats is not None else None
+            self.fc_infer(fact, rule, kb)
+            if stats is not None:
+                stats.charge(rule, start)
+
+    def agenda_empty(self, kb):
+        """Called by the KB whenever its agenda runs dry; nothing to do here
+        """
+        pass
+
+    def fact_removed(self, fact, kb):
+        """Called by the KB after a fact is removed; nothing to clean up here
+        """
+        pass
+
+    def rule_removed(self, rule, kb):
+        """Called by the KB after a rule is removed; nothing to clean up here
+        """
+        pass
+
+    def kb_loaded(self, kb):
+        """Called by KnowledgeBase.load once a saturated KB is restored;
+            nothing to rebuild here, rules are matched from kb.rules
+        """
+        pass
+
     def fc_infer(self, fact, rule, kb):
         """Forward-chaining to infer new facts and rules
 
@@ -223,14 +962,17 @@ class InferenceEngine(object):
         ####################################################
         # Student code goes here
         if len(rule.lhs) > 0:
-            # get first element of rule.lhs
-            rule_1 = rule.lhs[0]
-            # using this, check for match with fact.statement
-            r_bind = match(fact.statement, rule_1)
+            # get the compiled first element of rule.lhs
+            rule_1 = rule.patterns[0]
+            # using this, check for match with fact.statement; values holds
+            # the bound value of every variable slot of the rule
+            values = rule_1.match(fact.statement.ids)
+            if kb.stats is not None:
+                kb.stats.matched(rule, values is not None)
 
             # if match found
-            if r_bind:
-                item = instantiate(rule.rhs, r_bind)
+            if values is not None:
+                item = Statement.from_ids(rule.patterns[-1].instantiate(values))
                 # if rule.lhs has length 1, item must be an inferred fact
                 if len(rule.lhs) == 1:
                     # must be fact
@@ -238,12 +980,8 @@ class InferenceEngine(object):
                     new_fact = Fact(item, [[fact, rule]])
                     # add this new fact to the kb
                     kb.kb_assert(new_fact)
-                    # get the kb.fact from the kb
-                    new_fact = kb._get_fact(new_fact)
-
-                    # rule and fact supports the new_fact from the kb
-                    rule.supports_facts.append(new_fact)
-                    fact.supports_facts.append(new_fact)
+                    # the KB's support graph now records that rule and fact
+                    # support the new fact
 
                 else:
                     # len(rule.lhs) is not 0 and 1 so must be greater than 1 since
@@ -251,18 +989,14 @@ class InferenceEngine(object):
                     # must be rule
                     rules_except_1 = []
                     # create an array of all the other rules in lhs except the 1st one
-                    for r in rule.lhs[1:]:
+                    for r in rule.patterns[1:-1]:
                         # instantiate all the remaining lhs items with the binding we found
-                        rules_except_1.append(instantiate(r, r_bind))
+                        rules_except_1.append(Statement.from_ids(r.instantiate(values)))
                     # create new rules
                     new_rule = Rule([rules_except_1, item], [[fact, rule]])
                     # add this to the KB
                     kb.kb_assert(new_rule)
-                    # get the actual kb.rule from the KB
-                    new_rule = kb._get_rule(new_rule)
-
-                    # rule and fact supports new_rule from the kb
-                    rule.supports_rules.append(new_rule)
-                    fact.supports_rules.append(new_rule)
+                    # the KB's support graph now records that rule and fact
+                    # support the new rule
         else:
             return None
@@ -30,11 +30,52 @@ def match(state1, state2, bindings=None):
     Returns:
         Bindings|False: either associated bindings or no match found
     """
-    if len(state1.terms) != len(state2.terms) or state1.predicate != state2.predicate:
+    bound = dict(bindings.ids) if bindings else {}
+    if not match_ids(state1.ids, state2.ids, bound):
         return False
     if not bindings:
-        bindings = lc.Bindings()
-    return match_recursive(state1.terms, state2.terms, bindings)
+        return lc.Bindings.from_ids(bound)
+    terms = lc.SYMBOLS.terms
+    for variable, value in bound.items():
+        if variable not in bindings.ids:
+            bindings.add_binding(terms[variable].term, terms[value].term, variable, value)
+    return bindings
+
+def match_ids(ids1, ids2, bound):
+    """Match two statements given as symbol-id tuples (Statement.ids) in a
+        single pass over the argument positions. New bindings are written into
+        bound, which callers may clear and reuse between calls.
+
+    Args:
+        ids1 (tuple of int): statement to match with ids2
+        ids2 (tuple of int): statement to match with ids1
+        bound (dictof int): variable id => value id, already associated
+            bindings; extended in place (also on failure)
+
+    Returns:
+        bool: whether the statements match
+    """
+    if len(ids1) != len(ids2) or ids1[0] != ids2[0]:
+        return False
+    variable = lc.SYMBOLS.variable
+    for i in range(1, len(ids1)):
+        a = ids1[i]
+        b = ids2[i]
+        if variable[a]:
+            value = bound.get(a)
+            if value is None:
+                bound[a] = b
+            elif value != b:
+                return False
+        elif variable[b]:
+            value = bound.get(b)
+            if value is None:
+                bound[b] = a
+            elif value != a:
+                return False
+        elif a != b:
+            return False
+    return True
 
 def match_recursive(terms1, terms2, bindings):  # recursive...
     """Recursive helper for match
@@ -67,15 +108,20 @@ def instantiate(statement, bindings):
         statement (Statement): statement to generate new statement from
         bindings (Bindings): bindings to substitute into statement
     """
-    def handle_term(term):
-        if is_var(term):
-            bound_value = bindings.bound_to(term.term)
-            return lc.Term(bound_value) if bound_value else term
-        else:
-            return term
-
-    new_terms = [handle_term(t) for t in statement.terms]
-    return lc.Statement([statement.predicate] + new_terms)
+    return lc.Statement.from_ids(instantiate_ids(statement.ids, bindings.ids))
+
+def instantiate_ids(ids, bound):
+    """Substitute bound values into a statement given as a symbol-id tuple
+
+    Args:
+        ids (tuple of int): statement to instantiate (Statement.ids)
+        bound (dictof int): variable id => value id
+
+    Returns:
+        tuple of int: ids of the instantiated statement
+    """
+    get = bound.get
+    return (ids[0],) + tuple([get(i, i) for i in ids[1:]])
 
 def factq(element):
     """Check if element is a fact